@@ -0,0 +1,774 @@
+#!/usr/bin/env python3
+"""
+性能基准脚本
+在本地启动模拟上游服务器，测量 main.py 中各阶段在不同规模下的耗时
+用法: python benchmark.py probe --sizes 10,100,1000
+      python benchmark.py fetch --subscriptions 12
+      python benchmark.py base58 --sizes 10000,100000,1000000,5000000
+      python benchmark.py formats --sites 500,5000
+      python benchmark.py sniff --sizes 100000,1000000
+      python benchmark.py pipeline --sizes 50,500,5000 --output report.json
+      python benchmark.py validate --items 20,200,2000
+      python benchmark.py records --sites 1000,5000,20000
+      python benchmark.py merge --subscriptions 24 --sites 5000 --prefetch 1,4,16
+      python benchmark.py decode --sizes 10000,100000,1000000,5000000 --parallel 4
+"""
+
+import io
+import os
+import sys
+import time
+import json
+import math
+import random
+import hashlib
+import argparse
+import base58
+import base64
+import threading
+import tempfile
+import multiprocessing
+import contextlib
+import platform
+import subprocess
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from collections import defaultdict
+from typing import List, Dict, Any, Optional
+from urllib.parse import urlparse
+
+import main
+
+
+class MockServer(ThreadingHTTPServer):
+    """本地模拟上游服务器"""
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, latency_ms: float = 50.0, jitter_ms: float = 20.0, failure_rate: float = 0.0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.failure_rate = failure_rate
+        self.rng = random.Random(42)
+        self.rng_lock = threading.Lock()
+        self.bodies: Dict[str, bytes] = {}
+        self.default_body = b'{}'
+        super().__init__(('127.0.0.1', 0), MockHandler)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def resolve(self, path: str) -> bytes:
+        """返回 path 对应的响应体"""
+        return self.bodies.get(path, self.default_body)
+
+    def next_delay(self, path: str) -> Optional[float]:
+        """返回本次请求的模拟延迟（秒），None 表示本次请求失败"""
+        with self.rng_lock:
+            if self.rng.random() < self.failure_rate:
+                return None
+            delay = self.latency_ms + self.rng.uniform(-self.jitter_ms, self.jitter_ms)
+        return max(0.0, delay) / 1000
+
+    def handle_error(self, request, client_address):
+        # 客户端验证完成后会提前断开连接，不输出这类错误
+        if not isinstance(sys.exc_info()[1], (ConnectionError, TimeoutError)):
+            super().handle_error(request, client_address)
+
+    def start(self) -> 'MockServer':
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def start_process(self) -> 'MockServer':
+        """在子进程中运行，避免模拟服务器与被测代码争用 GIL；启动后不能再修改响应内容"""
+        self.process = multiprocessing.get_context('fork').Process(target=self.serve_forever, daemon=True)
+        self.process.start()
+        return self
+
+    def stop(self) -> None:
+        process = getattr(self, 'process', None)
+        if process is not None:
+            process.terminate()
+            process.join()
+            self.server_close()
+        else:
+            self.shutdown()
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _respond(self) -> None:
+        path = urlparse(self.path).path
+        delay = self.server.next_delay(path)
+        if delay is None:
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        time.sleep(delay)
+        body = self.server.resolve(path)
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_HEAD(self):
+        self._respond()
+
+    def do_GET(self):
+        self._respond()
+
+
+SEARCH_RESULT = json.dumps({'code': 1, 'msg': '数据列表', 'list': [{'vod_id': 1, 'vod_name': '庆余年'}]},
+                           ensure_ascii=False).encode('utf-8')
+
+
+def build_sites(base_url: str, count: int) -> Dict[str, Any]:
+    """生成 count 个指向模拟服务器的站点，其中约 1/10 为重名站点"""
+    sites = {}
+    for i in range(count):
+        group = i if i % 10 else i // 10
+        sites[f"api_{i + 1}"] = {
+            'name': f"源{i % 3}-站点{group}",
+            'api': f"{base_url}/site/{i}/api.php/provide/vod",
+        }
+    return {'api_site': sites}
+
+
+def timed(func, *args, **kwargs) -> float:
+    """静默执行 func 并返回耗时（秒）"""
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        func(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def bench_probe(args) -> List[Dict[str, Any]]:
+    """测量 remove_prefixes_and_filter_sites 的并发探测耗时"""
+    server = MockServer(args.latency, args.jitter, args.failure_rate).start()
+    server.default_body = SEARCH_RESULT
+    report = []
+    try:
+        for size in args.sizes:
+            # 所有模拟站点都在同一个主机上，单主机上限放宽到全局并发数
+            prober = main.SiteProber(main.ProbeEngine(args.concurrency, args.concurrency))
+            row = {'sites': size, 'concurrency': args.concurrency,
+                   'concurrent_s': round(timed(main.remove_prefixes_and_filter_sites,
+                                               build_sites(server.base_url, size), None, None, prober), 3)}
+            if args.sequential and size <= args.sequential:
+                prober = main.SiteProber(main.ProbeEngine(1, 1))
+                row['sequential_s'] = round(timed(main.remove_prefixes_and_filter_sites,
+                                                  build_sites(server.base_url, size), None, None, prober), 3)
+            report.append(row)
+            print(json.dumps(row, ensure_ascii=False))
+    finally:
+        server.shutdown()
+    return report
+
+
+def bench_fetch(args) -> Dict[str, Any]:
+    """对比串行与并发获取多个订阅源的耗时"""
+    server = MockServer(args.latency, args.jitter).start()
+    try:
+        urls = []
+        for i in range(args.subscriptions):
+            config = build_sites(f"https://example{i}.com", args.sites)
+            server.bodies[f"/sub/{i}"] = base58.b58encode(json.dumps(config).encode('utf-8'))
+            urls.append(f"{server.base_url}/sub/{i}")
+        session = main.get_http_session()
+        sequential = timed(lambda: [main.fetch_and_decode_subscription(url, session) for url in urls])
+        concurrent = timed(main.fetch_subscriptions, urls)
+        row = {'subscriptions': len(urls), 'latency_ms': args.latency,
+               'sequential_s': round(sequential, 3), 'concurrent_s': round(concurrent, 3)}
+        print(json.dumps(row, ensure_ascii=False))
+        return row
+    finally:
+        server.shutdown()
+
+
+def random_json_payload(size: int, seed: int = 0) -> bytes:
+    """生成约 size 字节的站点配置 JSON，用于编码相关的基准"""
+    rng = random.Random(seed)
+    sites = {}
+    payload = b'{}'
+    while len(payload) < size:
+        for _ in range(max(1, (size - len(payload)) // 120)):
+            i = len(sites) + 1
+            sites[f"api_{i}"] = {'name': f"站点{i}", 'api': f"https://api{rng.randrange(10**6)}.example.com/api.php/provide/vod",
+                                 'ttl': rng.randrange(2000)}
+        payload = json.dumps({'api_site': sites}, ensure_ascii=False, indent=2).encode('utf-8')
+    return payload[:size]
+
+
+def bench_base58(args) -> List[Dict[str, Any]]:
+    """对比分治 BASE58 编解码与 base58 库在不同负载大小下的耗时"""
+    report = []
+    for size in args.sizes:
+        data = random_json_payload(size)
+        start = time.perf_counter()
+        encoded = main.base58_encode(data)
+        encode_s = time.perf_counter() - start
+        start = time.perf_counter()
+        decoded = main.base58_decode(encoded)
+        decode_s = time.perf_counter() - start
+        assert decoded == data
+        row = {'bytes': size, 'encode_s': round(encode_s, 3), 'decode_s': round(decode_s, 3),
+               'legacy_encode_s': None, 'legacy_decode_s': None}
+        if size <= args.legacy_max:
+            start = time.perf_counter()
+            legacy = base58.b58encode(data)
+            row['legacy_encode_s'] = round(time.perf_counter() - start, 3)
+            start = time.perf_counter()
+            base58.b58decode(legacy)
+            row['legacy_decode_s'] = round(time.perf_counter() - start, 3)
+            row['identical'] = legacy == encoded
+        report.append(row)
+        print(json.dumps(row, ensure_ascii=False))
+    return report
+
+
+def bench_formats(args) -> List[Dict[str, Any]]:
+    """对比各输出格式的体积和编解码耗时"""
+    report = []
+    for count in args.sites:
+        config = {'cache_time': 7200, 'api_site': {
+            f"api_{i}": {'name': f"站点{i % 997}", 'api': f"https://api{i % 211}.example.com/api.php/provide/vod",
+                         'detail': f"https://api{i % 211}.example.com", 'ttl': (i * 37) % 2000}
+            for i in range(1, count + 1)}}
+        for output_format in main.OUTPUT_FORMATS:
+            start = time.perf_counter()
+            encoded = main.base58_encode(main.serialize_config(config, output_format))
+            encode_s = time.perf_counter() - start
+            start = time.perf_counter()
+            decoded = json.loads(main.unwrap_payload(main.base58_decode(encoded)))
+            decode_s = time.perf_counter() - start
+            assert decoded == config
+            row = {'sites': count, 'format': output_format,
+                   'payload_bytes': len(main.serialize_config(config, output_format)),
+                   'encoded_bytes': len(encoded), 'encode_s': round(encode_s, 3), 'decode_s': round(decode_s, 3)}
+            report.append(row)
+            print(json.dumps(row, ensure_ascii=False))
+    return report
+
+
+def legacy_decode(content: str) -> Any:
+    """原有的逐个尝试解码方式：先 BASE58，再 BASE64，最后按明文处理"""
+    try:
+        decoded = base58.b58decode(content).decode('utf-8')
+    except Exception:
+        try:
+            decoded = base64.b64decode(content).decode('utf-8')
+        except Exception:
+            decoded = content
+    return json.loads(decoded)
+
+
+def bench_sniff(args) -> List[Dict[str, Any]]:
+    """对比格式探测与逐个尝试解码在大体积明文 JSON / BASE64 输入上的耗时"""
+    report = []
+    for size in args.sizes:
+        payload = random_json_payload(size)
+        payload = payload[:payload.rfind(b'}', 0, len(payload) - 1) + 1] + b'}}'
+        inputs = {'json': payload.decode('utf-8'), 'base64': base64.b64encode(payload).decode('ascii')}
+        for name, content in inputs.items():
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                result = main.decode_subscription_content(content)
+            sniff_s = time.perf_counter() - start
+            start = time.perf_counter()
+            assert legacy_decode(content) == result
+            legacy_s = time.perf_counter() - start
+            row = {'bytes': len(content), 'input': name, 'detected': main.detect_payload_format(content),
+                   'sniff_s': round(sniff_s, 4), 'legacy_s': round(legacy_s, 4),
+                   'speedup': round(legacy_s / sniff_s, 2) if sniff_s else None}
+            report.append(row)
+            print(json.dumps(row, ensure_ascii=False))
+    return report
+
+
+def site_config_content(size: int, encoding: str) -> str:
+    """生成不小于 size 字节的合法站点配置 JSON，并按 encoding（base58 / base64 / json）编码为订阅源内容"""
+    rng = random.Random(size)
+    sites = {}
+    while True:
+        for _ in range(max(1, size // 150)):
+            i = len(sites) + 1
+            sites[f"api_{i}"] = {'name': f"站点{i}", 'api': f"https://api{rng.randrange(10**6)}.example.com/api.php/provide/vod",
+                                 'ttl': rng.randrange(2000)}
+        payload = json.dumps({'api_site': sites}, ensure_ascii=False).encode('utf-8')
+        if len(payload) >= size:
+            break
+    if encoding == 'base58':
+        return main.base58_encode(payload).decode('ascii')
+    if encoding == 'base64':
+        return base64.b64encode(payload).decode('ascii')
+    return payload.decode('utf-8')
+
+
+def bench_decode(args) -> List[Dict[str, Any]]:
+    """对比本进程解码与进程池解码在不同内容大小上的耗时，输出进程池开始占优的大小（交叉点）
+
+    single 为单个订阅源的解码耗时；parallel 为 --parallel 个同样大小的订阅源在多个线程中同时解码的总耗时，
+    对应获取阶段多个大订阅源同时到达的情况。
+    """
+    os.environ['DECODE_WORKERS'] = str(args.workers)
+    pool = main.get_decode_pool()
+    # 预热：启动全部子进程并完成导入
+    list(pool.map(main._decode_in_worker, ['{}'] * args.workers, [''] * args.workers))
+    report = []
+    crossover: Dict[str, Dict[str, Optional[int]]] = {}
+    for encoding in args.encodings:
+        crossover[encoding] = {'single': None, 'parallel': None}
+        for size in args.sizes:
+            content = site_config_content(size, encoding)
+
+            def inline():
+                main.decode_subscription_content(content)
+
+            def in_pool():
+                pool.submit(main._decode_in_worker, content, '').result()
+
+            def parallel(func):
+                with ThreadPoolExecutor(max_workers=args.parallel) as executor:
+                    list(executor.map(lambda _: func(), range(args.parallel)))
+
+            row = {'encoding': encoding, 'bytes': len(content), 'workers': args.workers, 'parallel': args.parallel,
+                   'inline_s': round(measure(inline, repeat=args.repeat)[0], 4),
+                   'pool_s': round(measure(in_pool, repeat=args.repeat)[0], 4),
+                   'inline_parallel_s': round(measure(parallel, inline, repeat=args.repeat)[0], 4),
+                   'pool_parallel_s': round(measure(parallel, in_pool, repeat=args.repeat)[0], 4)}
+            for mode, inline_key, pool_key in (('single', 'inline_s', 'pool_s'),
+                                               ('parallel', 'inline_parallel_s', 'pool_parallel_s')):
+                if crossover[encoding][mode] is None and row[pool_key] < row[inline_key]:
+                    crossover[encoding][mode] = len(content)
+            report.append(row)
+            print(json.dumps(row, ensure_ascii=False))
+    print(json.dumps({'crossover_bytes': crossover, 'cpus': os.cpu_count()}, ensure_ascii=False))
+    return report
+
+
+class PipelineMockServer(MockServer):
+    """整条流水线的模拟上游
+
+    /sub/<n> 返回预先生成的订阅源；/site/<i>/... 为模拟的 provide/vod 搜索接口，
+    延迟按 latency_dist 分布抽样，按 failure_rate 返回 503，响应体包含 payload_items 条记录。
+    约 at_json_rate 比例的站点只有 /at/json/ 变体有效，约 invalid_rate 比例的站点始终返回空结果。
+    """
+
+    def __init__(self, latency_ms: float, jitter_ms: float, failure_rate: float, latency_dist: str = 'lognormal',
+                 payload_items: int = 20, at_json_rate: float = 0.1, invalid_rate: float = 0.1):
+        super().__init__(latency_ms, jitter_ms, failure_rate)
+        self.latency_dist = latency_dist
+        self.at_json_rate = at_json_rate
+        self.invalid_rate = invalid_rate
+        items = [{'vod_id': i, 'vod_name': f"庆余年{i}", 'vod_play_url': f"第{i}集$https://example.com/{i}.m3u8" * 5}
+                 for i in range(max(1, payload_items))]
+        self.valid_body = json.dumps({'code': 1, 'msg': '数据列表', 'list': items}, ensure_ascii=False).encode('utf-8')
+        self.invalid_body = json.dumps({'code': 1, 'msg': '数据列表', 'list': []}).encode('utf-8')
+
+    @staticmethod
+    def site_index(path: str) -> Optional[int]:
+        parts = path.split('/')
+        if len(parts) > 2 and parts[1] == 'site' and parts[2].isdigit():
+            return int(parts[2])
+        return None
+
+    def site_traits(self, index: int) -> tuple:
+        """按站点编号确定性地决定 (是否只有 /at/json/ 有效, 是否始终无效)"""
+        rng = random.Random(index)
+        return rng.random() < self.at_json_rate, rng.random() < self.invalid_rate
+
+    def next_delay(self, path: str) -> Optional[float]:
+        if self.site_index(path) is None:
+            return super().next_delay(path)
+        with self.rng_lock:
+            if self.rng.random() < self.failure_rate:
+                return None
+            if self.latency_dist == 'lognormal':
+                sigma = self.jitter_ms / self.latency_ms if self.latency_ms else 0.0
+                delay = self.rng.lognormvariate(math.log(max(self.latency_ms, 0.001)), sigma)
+            elif self.latency_dist == 'exponential':
+                delay = self.rng.expovariate(1 / self.latency_ms) if self.latency_ms else 0.0
+            else:
+                delay = self.latency_ms + self.rng.uniform(-self.jitter_ms, self.jitter_ms)
+        return min(max(0.0, delay), 10_000) / 1000
+
+    def resolve(self, path: str) -> bytes:
+        index = self.site_index(path)
+        if index is None:
+            return super().resolve(path)
+        at_json_only, invalid = self.site_traits(index)
+        is_at_json = path.rstrip('/').endswith('/at/json')
+        return self.invalid_body if invalid or is_at_json != at_json_only else self.valid_body
+
+
+PIPELINE_ENCODERS = {
+    'base58': lambda data: main.base58_encode(data),
+    'base64': lambda data: base64.b64encode(data),
+    'plain': lambda data: data,
+}
+
+
+def build_subscriptions(server: PipelineMockServer, site_count: int, subscription_count: int) -> List[str]:
+    """把 site_count 个站点分散到多个订阅源中（含跨订阅源重复和重名站点），依次使用三种编码"""
+    subscription_count = max(1, subscription_count)
+    buckets: List[Dict[str, Any]] = [{} for _ in range(subscription_count)]
+    for i in range(site_count):
+        if i % 50 == 0:
+            name = f"豆瓣{i // 100}"
+        elif i % 10 == 0:
+            name = f"站点{i // 20}"
+        else:
+            name = f"站点{i}"
+        site = {'name': f"源{i % subscription_count}-{name}", 'api': f"{server.base_url}/site/{i}/api.php/provide/vod"}
+        targets = [i % subscription_count]
+        if i % 5 == 0:
+            targets.append((i + 1) % subscription_count)
+        for target in targets:
+            buckets[target][f"api_{len(buckets[target]) + 1}"] = dict(site)
+    urls = []
+    encodings = list(PIPELINE_ENCODERS)
+    for n, sites in enumerate(buckets):
+        payload = json.dumps({'cache_time': 7200, 'api_site': sites}, ensure_ascii=False).encode('utf-8')
+        server.bodies[f"/sub/{n}"] = PIPELINE_ENCODERS[encodings[n % len(encodings)]](payload)
+        urls.append(f"{server.base_url}/sub/{n}")
+    return urls
+
+
+def run_stage(stages: Dict[str, Any], name: str, track_memory: bool, func, *args, **kwargs) -> Any:
+    """静默执行一个阶段，记录耗时和（可选的）Python 堆内存峰值"""
+    if track_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = func(*args, **kwargs)
+    stage = {'wall_s': round(time.perf_counter() - start, 4)}
+    if track_memory:
+        stage['peak_mb'] = round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 2)
+        tracemalloc.stop()
+    stages[name] = stage
+    return result
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_pipeline(args) -> Dict[str, Any]:
+    """在模拟上游上完整运行 main.py 的各个阶段，输出每个阶段的耗时和内存峰值"""
+    report = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'config': {key: value for key, value in vars(args).items() if key != 'func'},
+        'runs': [],
+    }
+    with tempfile.TemporaryDirectory() as workdir:
+        for size in args.sizes:
+            server = PipelineMockServer(args.latency, args.jitter, args.failure_rate, args.latency_dist,
+                                        args.payload_items, args.at_json_rate, args.invalid_rate)
+            urls = build_subscriptions(server, size, args.subscriptions)
+            server.start_process()
+            try:
+                stream_file = os.path.join(workdir, 'stream.js')
+                with open(stream_file, 'w', encoding='utf-8') as f:
+                    f.write('const RESOURCE_SITES = `\n`;\n')
+                stages: Dict[str, Any] = {}
+                track = not args.no_memory
+                index = main.EndpointIndex()
+                merged = run_stage(stages, 'fetch_merge', track, main.merge_subscriptions,
+                                   (s for s in main.iter_subscriptions(urls) if s), index)
+                # 所有模拟站点都在同一个主机上，单主机上限放宽到全局并发数
+                prober = main.SiteProber(main.ProbeEngine(args.concurrency, args.concurrency), index=index)
+                merged = run_stage(stages, 'filter', track, main.remove_prefixes_and_filter_sites,
+                                   merged, args.ttl, None, prober)
+                run_stage(stages, 'encode', track, main.encode_and_save, merged,
+                          os.path.join(workdir, 'merged_config.b58'), args.output_format)
+                run_stage(stages, 'stream_js', track, main.generate_stream_js,
+                          merged.get('api_site', {}), stream_file, prober)
+            finally:
+                server.stop()
+            with open(stream_file, 'r', encoding='utf-8') as f:
+                valid_sites = sum(1 for line in f if ',http' in line)
+            run = {'sites': size, 'subscriptions': len(urls), 'kept_sites': len(merged.get('api_site', {})),
+                   'valid_sites': valid_sites, 'stages': stages,
+                   'total_s': round(sum(stage['wall_s'] for stage in stages.values()), 4)}
+            report['runs'].append(run)
+            print(json.dumps(run, ensure_ascii=False), file=sys.stderr)
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    return report
+
+
+def parse_sizes(value: str) -> List[int]:
+    return [int(v) for v in value.split(',') if v.strip()]
+
+
+def bench_validate(args) -> List[Dict[str, Any]]:
+    """对比完整下载后解析 JSON 与流式限量验证在不同大小搜索结果上的读取量和耗时"""
+    report = []
+    for items in args.items:
+        server = PipelineMockServer(0, 0, 0.0, 'uniform', items, 0.0, 0.0).start()
+        url = server.base_url + '/site/1/api.php/provide/vod/'
+        try:
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                body = main.get_probe_session().get(url, params=main.get_search_params(), timeout=30).content
+                assert json.loads(body)['code'] == 1
+            full_s = (time.perf_counter() - start) / args.repeat
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                result = main.probe_search_api(url)
+                assert result['valid']
+            stream_s = (time.perf_counter() - start) / args.repeat
+        finally:
+            server.shutdown()
+        row = {'items': items, 'body_bytes': len(body), 'stream_bytes': result['bytes'],
+               'full_ms': round(full_s * 1000, 2), 'stream_ms': round(stream_s * 1000, 2)}
+        report.append(row)
+        print(json.dumps(row, ensure_ascii=False))
+    return report
+
+
+def legacy_collect_sites(api_site: Dict[str, Any]) -> tuple:
+    """原有的站点收集方式：每个站点复制一份字典并包装为 site_info，另建豆瓣列表、名称分组和排序用的包装字典"""
+    sites_info = []
+    douban_sites = []
+    for key, site in api_site.items():
+        if 'name' in site:
+            name = site['name']
+            clean_name = name.split('-', 1)[1] if '-' in name else name
+        else:
+            name = clean_name = 'Unknown'
+        site_info = {'key': key, 'original_name': name, 'clean_name': clean_name, 'site': site.copy(),
+                     'is_douban': main.is_douban_resource(site)}
+        sites_info.append(site_info)
+        if site_info['is_douban']:
+            douban_sites.append(site_info)
+    name_groups = defaultdict(list)
+    for site_info in sites_info:
+        name_groups[site_info['clean_name']].append(site_info)
+    final_sites_with_ttl = [{'key': info['key'], 'site': info['site'], 'ttl': 0} for info in sites_info]
+    return sites_info, douban_sites, name_groups, final_sites_with_ttl
+
+
+def records_collect_sites(api_site: Dict[str, Any]) -> tuple:
+    """SiteIndex 方式：紧凑记录 + 索引，不复制站点字典"""
+    records = main.SiteIndex.from_sites(api_site)
+    for record in records.records:
+        record.ttl = 0
+    return records, records.douban_sites()
+
+
+class StaticProber(main.SiteProber):
+    """返回固定延迟的探测器，用于不联网地测量过滤阶段"""
+
+    def latencies(self, api_urls):
+        return {url: float(hash(url) % 3000) for url in api_urls}
+
+    def previous_latency(self, api_url):
+        return None
+
+
+def measure(func, *args, repeat: int = 5) -> tuple:
+    """返回 (最快一次的耗时, 一次调用期间的 Python 堆内存峰值 MB)"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            func(*args)
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = func(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del result
+    return best, peak / 1024 / 1024
+
+
+def bench_records(args) -> List[Dict[str, Any]]:
+    """对比原有的 site_info 字典方式与 SiteRecord/SiteIndex 方式在收集站点阶段的耗时和内存，并测量完整过滤阶段"""
+    report = []
+    for size in args.sites:
+        api_site = build_sites('http://127.0.0.1:1', size)['api_site']
+        for i, site in enumerate(api_site.values()):
+            if i % 20 == 0:
+                site['name'] += '豆瓣'
+        legacy_s, legacy_mb = measure(legacy_collect_sites, api_site)
+        records_s, records_mb = measure(records_collect_sites, api_site)
+        filter_s, filter_mb = measure(
+            lambda: main.remove_prefixes_and_filter_sites({'api_site': {k: dict(v) for k, v in api_site.items()}},
+                                                          2000, None, StaticProber()), repeat=3)
+        row = {'sites': size, 'legacy_s': round(legacy_s, 4), 'records_s': round(records_s, 4),
+               'legacy_peak_mb': round(legacy_mb, 2), 'records_peak_mb': round(records_mb, 2),
+               'filter_s': round(filter_s, 4), 'filter_peak_mb': round(filter_mb, 2)}
+        report.append(row)
+        print(json.dumps(row, ensure_ascii=False))
+    return report
+
+
+def build_large_subscriptions(server: MockServer, subscription_count: int, site_count: int) -> List[str]:
+    """生成 subscription_count 个各含 site_count 个站点的大订阅源，相邻订阅源之间约一半站点重复"""
+    urls = []
+    for n in range(subscription_count):
+        sites = {}
+        for i in range(site_count):
+            site_id = n * site_count // 2 + i
+            sites[f"api_{i + 1}"] = {
+                'key': f"site{site_id}", 'name': f"源{n}-站点{site_id}",
+                'api': f"https://host{site_id % 97}.example.com/{site_id}/api.php/provide/vod",
+                'detail': f"https://host{site_id % 97}.example.com/{site_id}/detail", 'type': 1,
+                'searchable': 1, 'quickSearch': 1, 'filterable': 1,
+                'ext': {'flag': f"flag{site_id}", 'header': {'User-Agent': 'okhttp/3.12.0'}},
+            }
+        payload = json.dumps({'cache_time': 7200, 'spider': f"jar{n}", 'api_site': sites},
+                             ensure_ascii=False).encode('utf-8')
+        server.bodies[f"/sub/{n}"] = base64.b64encode(payload)
+        urls.append(f"{server.base_url}/sub/{n}")
+    return urls
+
+
+def bench_merge(args) -> List[Dict[str, Any]]:
+    """对比先获取全部订阅源再合并与流式逐个合并的内存峰值和耗时，并确认两者的合并结果一致"""
+    server = MockServer(args.latency, args.jitter)
+    urls = build_large_subscriptions(server, args.subscriptions, args.sites)
+    server.start_process()
+    report = []
+
+    def collect_then_merge():
+        # 与原有流程一致：订阅源列表在合并期间及之后一直被持有
+        subscriptions = main.fetch_subscriptions(urls)
+        merged = main.merge_subscriptions([s for s in subscriptions if s])
+        return subscriptions, merged
+
+    def streaming(prefetch: int):
+        return main.merge_subscriptions(s for s in main.iter_subscriptions(urls, prefetch=prefetch) if s)
+
+    try:
+        baseline_s, baseline_mb = measure(collect_then_merge, repeat=1)
+        with contextlib.redirect_stdout(io.StringIO()):
+            expected = json.dumps(collect_then_merge()[1], ensure_ascii=False)
+        row = {'mode': 'collect', 'subscriptions': len(urls), 'sites': args.sites,
+               'wall_s': round(baseline_s, 3), 'peak_mb': round(baseline_mb, 2)}
+        report.append(row)
+        print(json.dumps(row, ensure_ascii=False))
+        for prefetch in args.prefetch:
+            wall_s, peak_mb = measure(streaming, prefetch, repeat=1)
+            with contextlib.redirect_stdout(io.StringIO()):
+                identical = json.dumps(streaming(prefetch), ensure_ascii=False) == expected
+            row = {'mode': 'streaming', 'prefetch': prefetch, 'subscriptions': len(urls), 'sites': args.sites,
+                   'wall_s': round(wall_s, 3), 'peak_mb': round(peak_mb, 2), 'identical': identical}
+            report.append(row)
+            print(json.dumps(row, ensure_ascii=False))
+    finally:
+        server.stop()
+    return report
+
+
+def main_cli(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description='main.py 性能基准')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    probe = subparsers.add_parser('probe', help='并发延迟探测耗时')
+    probe.add_argument('--sizes', type=parse_sizes, default=[10, 100, 1000])
+    probe.add_argument('--concurrency', type=int, default=32)
+    probe.add_argument('--latency', type=float, default=50.0, help='模拟延迟（毫秒）')
+    probe.add_argument('--jitter', type=float, default=20.0, help='延迟抖动（毫秒）')
+    probe.add_argument('--failure-rate', type=float, default=0.0)
+    probe.add_argument('--sequential', type=int, default=100,
+                       help='站点数不超过该值时同时测量串行耗时，0 表示不测量')
+    probe.set_defaults(func=bench_probe)
+
+    fetch = subparsers.add_parser('fetch', help='并发获取订阅源耗时')
+    fetch.add_argument('--subscriptions', type=int, default=12)
+    fetch.add_argument('--sites', type=int, default=50, help='每个订阅源中的站点数')
+    fetch.add_argument('--latency', type=float, default=500.0, help='模拟延迟（毫秒）')
+    fetch.add_argument('--jitter', type=float, default=200.0, help='延迟抖动（毫秒）')
+    fetch.set_defaults(func=bench_fetch)
+
+    codec = subparsers.add_parser('base58', help='BASE58 编解码耗时')
+    codec.add_argument('--sizes', type=parse_sizes, default=[10_000, 100_000, 1_000_000, 5_000_000])
+    codec.add_argument('--legacy-max', type=int, default=100_000,
+                       help='负载不超过该字节数时同时测量 base58 库（平方复杂度，大负载会非常慢）')
+    codec.set_defaults(func=bench_base58)
+
+    formats = subparsers.add_parser('formats', help='各输出格式的体积与编解码耗时')
+    formats.add_argument('--sites', type=parse_sizes, default=[500, 5000])
+    formats.set_defaults(func=bench_formats)
+
+    sniff = subparsers.add_parser('sniff', help='格式探测与逐个尝试解码的耗时对比')
+    sniff.add_argument('--sizes', type=parse_sizes, default=[100_000, 1_000_000, 5_000_000])
+    sniff.set_defaults(func=bench_sniff)
+
+    pipeline = subparsers.add_parser('pipeline', help='在模拟上游上运行完整流水线，输出各阶段耗时与内存峰值')
+    pipeline.add_argument('--sizes', type=parse_sizes, default=[50, 500, 5000])
+    pipeline.add_argument('--subscriptions', type=int, default=6)
+    pipeline.add_argument('--concurrency', type=int, default=64)
+    pipeline.add_argument('--latency', type=float, default=80.0, help='搜索接口延迟的中位数/均值（毫秒）')
+    pipeline.add_argument('--jitter', type=float, default=40.0, help='延迟抖动（毫秒），lognormal 分布时决定 sigma')
+    pipeline.add_argument('--latency-dist', choices=['uniform', 'lognormal', 'exponential'], default='lognormal')
+    pipeline.add_argument('--failure-rate', type=float, default=0.05, help='搜索接口返回 503 的概率')
+    pipeline.add_argument('--invalid-rate', type=float, default=0.1, help='始终返回空结果的站点比例')
+    pipeline.add_argument('--at-json-rate', type=float, default=0.1, help='只有 /at/json/ 变体有效的站点比例')
+    pipeline.add_argument('--payload-items', type=int, default=20, help='搜索结果中的记录数')
+    pipeline.add_argument('--ttl', type=int, default=None, help='延迟过滤阈值（毫秒）')
+    pipeline.add_argument('--output-format', choices=list(main.OUTPUT_FORMATS), default='pretty')
+    pipeline.add_argument('--no-memory', action='store_true', help='不统计内存峰值（tracemalloc 会拖慢 CPU 密集的阶段）')
+    pipeline.add_argument('--output', help='报告输出文件，默认打印到标准输出')
+    pipeline.set_defaults(func=bench_pipeline)
+
+    validate = subparsers.add_parser('validate', help='完整下载与流式限量验证的读取量和耗时对比')
+    validate.add_argument('--items', type=parse_sizes, default=[20, 200, 2000], help='搜索结果中的记录数')
+    validate.add_argument('--repeat', type=int, default=20)
+    validate.set_defaults(func=bench_validate)
+
+    records = subparsers.add_parser('records', help='site_info 字典与 SiteRecord 记录的耗时和内存对比')
+    records.add_argument('--sites', type=parse_sizes, default=[1000, 5000, 20000])
+    records.set_defaults(func=bench_records)
+
+    merge = subparsers.add_parser('merge', help='先获取全部订阅源再合并与流式合并的内存峰值对比')
+    merge.add_argument('--subscriptions', type=int, default=24)
+    merge.add_argument('--sites', type=int, default=5000, help='每个订阅源中的站点数')
+    merge.add_argument('--prefetch', type=parse_sizes, default=[1, 4, 16], help='流式合并的预取窗口大小')
+    merge.add_argument('--latency', type=float, default=50.0, help='模拟延迟（毫秒）')
+    merge.add_argument('--jitter', type=float, default=20.0, help='延迟抖动（毫秒）')
+    merge.set_defaults(func=bench_merge)
+
+    decode = subparsers.add_parser('decode', help='本进程解码与进程池解码的耗时对比及交叉点')
+    decode.add_argument('--sizes', type=parse_sizes, default=[10_000, 100_000, 1_000_000, 5_000_000])
+    decode.add_argument('--encodings', type=lambda value: value.split(','), default=['base58', 'base64', 'json'])
+    decode.add_argument('--workers', type=int, default=max(1, min(4, (os.cpu_count() or 1) - 1)), help='解码进程数')
+    decode.add_argument('--parallel', type=int, default=4, help='同时解码的订阅源数')
+    decode.add_argument('--repeat', type=int, default=3)
+    decode.set_defaults(func=bench_decode)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main_cli()
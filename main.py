@@ -6,16 +6,539 @@
 """
 
 import os
+import io
+import re
 import sys
+import socket
+import ipaddress
+import unicodedata
+import gzip
 import json
+import argparse
 import base64
 import base58
+import decimal
 import time
-from typing import List, Dict, Any, Optional
+import datetime
+import zlib
+import hashlib
+import threading
+import multiprocessing
+import difflib
+from collections import defaultdict, deque
+from contextlib import contextmanager, redirect_stdout
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Dict, Any, Optional, Callable, Iterable, Iterator, Union
+from urllib.parse import urlparse, urlunparse, parse_qsl
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import connection as urllib3_connection
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 
 
+def get_env_int(name: str, default: int) -> int:
+    """读取整数类型的环境变量，未设置或非法时返回默认值"""
+    value = os.getenv(name)
+    if not value:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        print(f"Warning: invalid {name}={value!r}, using {default}")
+        return default
+
+
+def get_env_float(name: str, default: float) -> float:
+    """读取浮点类型的环境变量，未设置或非法时返回默认值"""
+    value = os.getenv(name)
+    if not value:
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        print(f"Warning: invalid {name}={value!r}, using {default}")
+        return default
+
+
+def get_env_bool(name: str, default: bool = False) -> bool:
+    """读取布尔类型的环境变量（1/true/yes/on 视为真）"""
+    value = os.getenv(name)
+    if not value:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def get_cache_dir() -> str:
+    """本地状态缓存目录，默认 .cache"""
+    return os.getenv('CACHE_DIR') or '.cache'
+
+
+class CassetteAdapter(HTTPAdapter):
+    """录制 / 回放 HTTP 请求的传输适配器
+
+    record 模式下通过内部适配器发出真实请求，把每个请求的结果（状态码、响应头、完整响应体，
+    或请求失败的异常类型）连同耗时追加写入 JSONL 磁带；elapsed 为收到响应头的耗时，duration 含读取响应体。
+    流式请求也会先读取完整响应体再返回，因此录制时的探测耗时包含完整下载。
+
+    replay 模式下不访问网络：按 (方法, URL) 依次取出录制的结果（用完后重复最后一条），
+    按 elapsed 乘以 scale 模拟延迟（默认 0，即全速回放），磁带中没有的请求按连接失败处理。
+    """
+
+    def __init__(self, cassette: 'HttpCassette', inner: Optional[HTTPAdapter] = None):
+        super().__init__()
+        self.cassette = cassette
+        self.inner = inner
+
+    def send(self, request: requests.PreparedRequest, **kwargs: Any) -> requests.Response:
+        if self.cassette.mode == 'replay':
+            return self.cassette.replay(request)
+        start_time = time.time()
+        try:
+            response = self.inner.send(request, **kwargs)
+            elapsed = time.time() - start_time
+            body = response.content
+        except requests.RequestException as e:
+            self.cassette.record(request, {'error': type(e).__name__, 'message': str(e),
+                                           'elapsed': round(time.time() - start_time, 4)})
+            raise
+        entry = {'status': response.status_code, 'headers': dict(response.headers),
+                 'elapsed': round(elapsed, 4), 'duration': round(time.time() - start_time, 4)}
+        try:
+            entry['body'] = body.decode('utf-8')
+        except UnicodeDecodeError:
+            entry['body_b64'] = base64.b64encode(body).decode('ascii')
+        self.cassette.record(request, entry)
+        response.cassette_timing = (entry['elapsed'], entry['duration'])
+        return response
+
+    def close(self) -> None:
+        if self.inner is not None:
+            self.inner.close()
+
+
+class HttpCassette:
+    """HTTP 录制 / 回放的磁带（JSONL，每行一个请求）
+
+    HTTP_RECORD 指定录制的磁带文件，HTTP_REPLAY 指定回放的磁带文件（两者同时设置时以回放为准），
+    REPLAY_LATENCY_SCALE 为回放时模拟延迟的倍数（默认 0，1 表示按录制时的耗时等待）。
+    开启后所有共享会话（订阅源获取、HEAD 检查、搜索验证）都经过磁带；回放时同时关闭 DNS 预解析。
+    """
+
+    # 回放时不还原的响应头：响应体已按解码后的内容保存
+    SKIPPED_HEADERS = ('content-encoding', 'transfer-encoding', 'content-length')
+
+    def __init__(self):
+        self.mode: Optional[str] = None
+        self.path: Optional[str] = None
+        self.scale = 0.0
+        self.entries: Dict[tuple, List[Dict[str, Any]]] = {}
+        self.positions: Dict[tuple, int] = {}
+        self._lock = threading.Lock()
+
+    def configure(self) -> None:
+        """读取 HTTP_RECORD / HTTP_REPLAY，需在创建共享会话之前调用"""
+        replay_path, record_path = os.getenv('HTTP_REPLAY'), os.getenv('HTTP_RECORD')
+        if replay_path:
+            self.mode, self.path = 'replay', replay_path
+            self.scale = get_env_float('REPLAY_LATENCY_SCALE', 0.0)
+            self.entries, self.positions = {}, {}
+            with open(replay_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.entries.setdefault((entry['method'], entry['url']), []).append(entry)
+            print(f"Replaying HTTP from {replay_path}: {sum(len(v) for v in self.entries.values())} recorded requests")
+        elif record_path:
+            self.mode, self.path = 'record', record_path
+            os.makedirs(os.path.dirname(record_path) or '.', exist_ok=True)
+            open(record_path, 'w', encoding='utf-8').close()
+            print(f"Recording HTTP to {record_path}")
+
+    def wrap(self, adapter: HTTPAdapter) -> HTTPAdapter:
+        """开启录制或回放时用磁带适配器包装会话的适配器"""
+        return CassetteAdapter(self, adapter) if self.mode else adapter
+
+    def record(self, request: requests.PreparedRequest, entry: Dict[str, Any]) -> None:
+        line = json.dumps({'ts': round(time.time(), 3), 'method': request.method, 'url': request.url, **entry},
+                          ensure_ascii=False)
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line + '\n')
+
+    def replay(self, request: requests.PreparedRequest) -> requests.Response:
+        key = (request.method, request.url)
+        with self._lock:
+            recorded = self.entries.get(key)
+            if not recorded:
+                entry = None
+            else:
+                position = self.positions.get(key, 0)
+                entry = recorded[min(position, len(recorded) - 1)]
+                self.positions[key] = position + 1
+        if entry is None:
+            raise requests.ConnectionError(f"Not in cassette: {request.method} {request.url}", request=request)
+        if self.scale > 0:
+            time.sleep(entry.get('elapsed', 0) * self.scale)
+        if 'error' in entry:
+            error_class = getattr(requests.exceptions, entry['error'], requests.ConnectionError)
+            if not (isinstance(error_class, type) and issubclass(error_class, requests.RequestException)):
+                error_class = requests.ConnectionError
+            raise error_class(entry.get('message', entry['error']), request=request)
+        response = requests.Response()
+        response.status_code = entry['status']
+        response.headers = requests.structures.CaseInsensitiveDict(
+            {name: value for name, value in entry.get('headers', {}).items()
+             if name.lower() not in self.SKIPPED_HEADERS})
+        body = base64.b64decode(entry['body_b64']) if 'body_b64' in entry else entry.get('body', '').encode('utf-8')
+        response.raw = io.BytesIO(body)
+        response.url = request.url
+        response.request = request
+        response.reason = ''
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.elapsed = datetime.timedelta(seconds=entry.get('elapsed', 0))
+        response.cassette_timing = (entry.get('elapsed', 0), entry.get('duration', entry.get('elapsed', 0)))
+        return response
+
+
+# 进程内的 HTTP 录制 / 回放设置，main() 开始时读取
+http_cassette = HttpCassette()
+
+
+def response_timing(response: requests.Response, start_time: float, full: bool = True) -> float:
+    """返回请求耗时（毫秒），full 为 False 时只算到收到响应头
+
+    经过录制 / 回放磁带的响应使用磁带中记录的耗时，使回放时的延迟排序与录制时一致
+    """
+    timing = getattr(response, 'cassette_timing', None)
+    if timing is not None:
+        return timing[1 if full else 0] * 1000
+    return (time.time() - start_time) * 1000
+
+
+_http_session: Optional[requests.Session] = None
+_http_session_lock = threading.Lock()
+
+
+def get_http_session() -> requests.Session:
+    """获取共享的 HTTP 会话：连接池复用 keep-alive 连接，失败时按指数退避重试"""
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            pool_size = get_env_int('HTTP_POOL_SIZE', 16)
+            retry = Retry(
+                total=get_env_int('HTTP_RETRIES', 2),
+                backoff_factor=get_env_float('HTTP_BACKOFF', 0.5),
+                status_forcelist=(429, 500, 502, 503, 504),
+                allowed_methods=frozenset(['GET', 'HEAD']),
+            )
+            adapter = http_cassette.wrap(HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry))
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _http_session = session
+        return _http_session
+
+
+def redact_url(url: str) -> str:
+    """把 URL 脱敏为主机名加 sha1 前缀（与订阅源增量状态的键一致），用于写入可能被缓存或上传的运行报告"""
+    host = (urlparse(url).hostname or '').lower()
+    return f"{host}#{hashlib.sha1(url.encode('utf-8')).hexdigest()[:12]}"
+
+
+class RunMetrics:
+    """单次运行的结构化指标
+
+    span 记录阶段（kind='stage'）、每次网络调用（kind='http'）以及 DNS 解析（kind='dns'）和建立连接（kind='tcp'）的耗时，incr 累加计数器
+    （发起的探测数、超时数、缓存命中、下载字节数、保留/过滤的站点数等）。
+    运行结束时 export 写出 JSON 运行报告（RUN_REPORT_FILE）和 Prometheus 文本文件（METRICS_FILE）。
+    span 和 event 的 url 属性只保存脱敏后的形式：订阅源 URL 来自密钥，而报告默认写在会被缓存的 CACHE_DIR 中。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    # 即使本轮为 0 也输出的计数器，便于按时间绘制失败率
+    COUNTERS = ('bytes_downloaded', 'subscriptions_decoded', 'subscriptions_not_modified',
+                'subscriptions_unchanged', 'subscriptions_failed', 'probes_issued', 'probes_valid',
+                'probe_bytes', 'probe_timeouts', 'probe_errors', 'probe_hedges', 'probes_skipped_budget',
+                'probe_cache_hits', 'probe_cache_misses', 'breaker_skipped', 'breaker_half_open',
+                'breaker_recovered', 'probes_skipped_stable',
+                'sites_input', 'sites_kept', 'sites_dropped', 'stream_sites_valid', 'output_bytes',
+                'delta_bytes', 'delta_ops', 'dns_lookups', 'dns_cache_hits', 'dns_failures', 'dns_timeouts',
+                'dns_dropped', 'subscriptions_decoded_in_pool')
+
+    def reset(self) -> None:
+        with self._lock:
+            self.started_at = time.time()
+            self.spans: List[Dict[str, Any]] = []
+            self.events: List[Dict[str, Any]] = []
+            self.counters: Dict[str, float] = defaultdict(float, dict.fromkeys(self.COUNTERS, 0))
+
+    @contextmanager
+    def span(self, name: str, kind: str = 'stage', **attrs: Any) -> Iterator[Dict[str, Any]]:
+        """记录一段代码的耗时，调用方可以向返回的记录中补充属性（如 HTTP 状态码）"""
+        start_time = time.time()
+        if 'url' in attrs:
+            attrs['url'] = redact_url(attrs['url'])
+        record = {'name': name, 'kind': kind, 'start': round(start_time - self.started_at, 4), **attrs}
+        try:
+            yield record
+        except BaseException as e:
+            record['error'] = type(e).__name__
+            raise
+        finally:
+            record['duration'] = round(time.time() - start_time, 4)
+            with self._lock:
+                self.spans.append(record)
+
+    def incr(self, name: str, value: float = 1) -> None:
+        with self._lock:
+            self.counters[name] += value
+
+    def event(self, name: str, **attrs: Any) -> None:
+        """记录一条决策事件（如熔断跳过），写入运行报告"""
+        if 'url' in attrs:
+            attrs['url'] = redact_url(attrs['url'])
+        with self._lock:
+            self.events.append({'name': name, 'at': round(time.time() - self.started_at, 4), **attrs})
+
+    def summary(self) -> Dict[str, Dict[str, Dict[str, float]]]:
+        """按 kind 和 name 汇总 span：次数、总耗时、最大耗时"""
+        summary: Dict[str, Dict[str, Dict[str, float]]] = defaultdict(dict)
+        with self._lock:
+            spans = list(self.spans)
+        for record in spans:
+            entry = summary[record['kind']].setdefault(record['name'], {'count': 0, 'total': 0.0, 'max': 0.0})
+            entry['count'] += 1
+            entry['total'] += record['duration']
+            entry['max'] = max(entry['max'], record['duration'])
+            if 'error' in record:
+                entry['errors'] = entry.get('errors', 0) + 1
+        return summary
+
+    def report(self, status: str) -> Dict[str, Any]:
+        with self._lock:
+            spans = list(self.spans)
+            counters = dict(self.counters)
+            events = list(self.events)
+        return {
+            'status': status,
+            'started_at': self.started_at,
+            'duration': round(time.time() - self.started_at, 4),
+            'stages': {name: entry['total'] for name, entry in self.summary().get('stage', {}).items()},
+            'counters': counters,
+            # DNS 解析、建立连接和完整请求（含连接）的累计耗时，便于区分解析慢和站点慢
+            'network': {kind: round(sum(entry['total'] for entry in self.summary().get(kind, {}).values()), 4)
+                        for kind in ('dns', 'tcp', 'http')},
+            'summary': self.summary(),
+            'events': events,
+            'spans': spans,
+        }
+
+    def prometheus_text(self, status: str, prefix: str = 'tvbox_merge') -> str:
+        """生成 node_exporter textfile collector 可读取的指标文本"""
+        summary = self.summary()
+        lines = [
+            f"# HELP {prefix}_run_timestamp_seconds Start time of the last run.",
+            f"# TYPE {prefix}_run_timestamp_seconds gauge",
+            f"{prefix}_run_timestamp_seconds {self.started_at:.3f}",
+            f"# HELP {prefix}_run_duration_seconds Wall time of the last run.",
+            f"# TYPE {prefix}_run_duration_seconds gauge",
+            f"{prefix}_run_duration_seconds {time.time() - self.started_at:.4f}",
+            f"# HELP {prefix}_run_success Whether the last run finished without error.",
+            f"# TYPE {prefix}_run_success gauge",
+            f"{prefix}_run_success {0 if status == 'failed' else 1}",
+            f"# HELP {prefix}_stage_duration_seconds Wall time of each pipeline stage in the last run.",
+            f"# TYPE {prefix}_stage_duration_seconds gauge",
+        ]
+        for name, entry in summary.get('stage', {}).items():
+            lines.append(f'{prefix}_stage_duration_seconds{{stage="{name}"}} {entry["total"]:.4f}')
+        lines += [
+            f"# HELP {prefix}_http_request_duration_seconds Network calls made in the last run.",
+            f"# TYPE {prefix}_http_request_duration_seconds summary",
+        ]
+        for name, entry in summary.get('http', {}).items():
+            lines.append(f'{prefix}_http_request_duration_seconds_sum{{call="{name}"}} {entry["total"]:.4f}')
+            lines.append(f'{prefix}_http_request_duration_seconds_count{{call="{name}"}} {entry["count"]}')
+        for kind, metric, help_text in (('dns', 'dns_resolve', 'DNS lookups'), ('tcp', 'connect', 'TCP connects')):
+            entries = summary.get(kind, {}).values()
+            lines += [
+                f"# HELP {prefix}_{metric}_duration_seconds {help_text} made in the last run.",
+                f"# TYPE {prefix}_{metric}_duration_seconds summary",
+                f"{prefix}_{metric}_duration_seconds_sum {sum(entry['total'] for entry in entries):.4f}",
+                f"{prefix}_{metric}_duration_seconds_count {sum(entry['count'] for entry in entries)}",
+            ]
+        with self._lock:
+            counters = sorted(self.counters.items())
+        for name, value in counters:
+            lines.append(f"# TYPE {prefix}_{name}_total counter")
+            lines.append(f"{prefix}_{name}_total {value:g}")
+        return '\n'.join(lines) + '\n'
+
+    def export(self, status: str) -> None:
+        """写出 JSON 运行报告和 Prometheus 文本文件（均为原子写入）"""
+        stages = self.summary().get('stage', {})
+        if stages:
+            print("Stage timings: " + ', '.join(f"{name} {entry['total']:.2f}s" for name, entry in stages.items()))
+        outputs = [
+            (os.getenv('RUN_REPORT_FILE') or os.path.join(get_cache_dir(), 'run_report.json'),
+             lambda: json.dumps(self.report(status), ensure_ascii=False, indent=2)),
+            (os.getenv('METRICS_FILE'), lambda: self.prometheus_text(status)),
+        ]
+        for path, render in outputs:
+            if not path:
+                continue
+            try:
+                os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+                tmp_path = path + '.tmp'
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    f.write(render())
+                os.replace(tmp_path, path)
+            except OSError as e:
+                print(f"Warning: failed to write metrics to {path}: {e}")
+
+
+# 当前运行的指标，main() 开始时重置
+metrics = RunMetrics()
+
+
+_probe_session: Optional[requests.Session] = None
+
+
+def get_probe_session() -> requests.Session:
+    """获取探测专用的共享会话：不重试（避免重试计入延迟），连接池按探测并发数配置，常驻模式下跨轮复用"""
+    global _probe_session
+    with _http_session_lock:
+        if _probe_session is None:
+            pool_size = get_env_int('PROBE_CONCURRENCY', 32)
+            adapter = http_cassette.wrap(HTTPAdapter(pool_connections=max(pool_size, 256), pool_maxsize=pool_size,
+                                                     max_retries=0))
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _probe_session = session
+        return _probe_session
+
+
+class DnsCache:
+    """进程内的 DNS 解析缓存
+
+    pre-resolve 阶段并发解析 api_site 中所有不同的主机名，结果按 DNS_CACHE_TTL 秒过期；
+    安装到 urllib3 的 create_connection 后，所有 requests 请求都直接使用缓存的地址建立连接，
+    DNS 解析时间不再计入站点延迟。解析失败（或超过 DNS_TIMEOUT 秒）的主机同样缓存，
+    之后的请求立即失败，探测阶段直接丢弃这些站点而不发起 HTTP 请求。IP 地址不经过缓存。
+    """
+
+    def __init__(self):
+        self.ttl = 0.0
+        self.entries: Dict[str, tuple] = {}
+        self._lock = threading.Lock()
+        self._original_create_connection: Optional[Callable[..., socket.socket]] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self._original_create_connection is not None
+
+    def install(self) -> None:
+        """按 DNS_CACHE_TTL（默认 300 秒，0 表示关闭）替换 urllib3 的 create_connection，重复调用只替换一次"""
+        self.ttl = get_env_float('DNS_CACHE_TTL', 300)
+        if self.ttl > 0 and self._original_create_connection is None:
+            self._original_create_connection = urllib3_connection.create_connection
+            urllib3_connection.create_connection = self.create_connection
+
+    @staticmethod
+    def is_ip(host: str) -> bool:
+        try:
+            ipaddress.ip_address(host.strip('[]'))
+            return True
+        except ValueError:
+            return False
+
+    def _cached(self, host: str) -> Optional[List[str]]:
+        """返回未过期的缓存地址（解析失败为空列表），没有缓存时返回 None"""
+        with self._lock:
+            entry = self.entries.get(host)
+        if entry is None or entry[0] < time.time():
+            return None
+        return entry[1]
+
+    def _resolve(self, host: str) -> List[str]:
+        """实际解析主机名并写入缓存，失败时缓存空列表"""
+        with metrics.span('resolve', kind='dns', host=host) as record:
+            try:
+                infos = socket.getaddrinfo(host, None, urllib3_connection.allowed_gai_family(), socket.SOCK_STREAM)
+                addresses = list(dict.fromkeys(info[4][0] for info in infos))
+            except (socket.gaierror, UnicodeError) as e:
+                record['error'] = type(e).__name__
+                addresses = []
+        with self._lock:
+            self.entries[host] = (time.time() + self.ttl, addresses)
+        metrics.incr('dns_lookups')
+        if not addresses:
+            metrics.incr('dns_failures')
+        return addresses
+
+    def resolve(self, host: str) -> List[str]:
+        addresses = self._cached(host)
+        if addresses is not None:
+            metrics.incr('dns_cache_hits')
+            return addresses
+        return self._resolve(host)
+
+    def prefetch(self, hosts: Iterable[str], max_workers: Optional[int] = None,
+                 timeout: Optional[float] = None) -> int:
+        """并发解析缓存中没有的主机名，返回本次解析失败的主机数；超时未完成的主机按解析失败处理"""
+        if not self.enabled:
+            return 0
+        pending = [host for host in dict.fromkeys(hosts) if host and not self.is_ip(host) and self._cached(host) is None]
+        if not pending:
+            return 0
+        timeout = timeout if timeout is not None else get_env_float('DNS_TIMEOUT', 5.0)
+        workers = min(max_workers or get_env_int('DNS_CONCURRENCY', 32), len(pending))
+        start_time = time.time()
+        executor = ThreadPoolExecutor(max_workers=max(1, workers))
+        futures = {executor.submit(self._resolve, host): host for host in pending}
+        done, not_done = wait(futures, timeout=timeout)
+        # 解析卡住的主机不再等待，后台线程结束后会写入真实结果
+        executor.shutdown(wait=False, cancel_futures=True)
+        with self._lock:
+            for future in not_done:
+                self.entries[futures[future]] = (time.time() + self.ttl, [])
+        metrics.incr('dns_timeouts', len(not_done))
+        failed = sum(1 for future in done if not future.result()) + len(not_done)
+        print(f"DNS 预解析 {len(pending)} 个主机完成，耗时 {time.time() - start_time:.2f}s，"
+              f"{failed} 个无法解析{f'（其中 {len(not_done)} 个超时）' if not_done else ''}")
+        return failed
+
+    def is_unresolvable(self, host: str) -> bool:
+        """主机名已缓存为解析失败"""
+        return self.enabled and self._cached(host) == []
+
+    def create_connection(self, address: tuple, *args: Any, **kwargs: Any) -> socket.socket:
+        """urllib3 create_connection 的替代：按缓存的地址依次尝试连接，连接耗时单独记录"""
+        host, port = address
+        original = self._original_create_connection
+        addresses = [host] if self.is_ip(host) or self.ttl <= 0 else self.resolve(host)
+        if not addresses:
+            raise socket.gaierror(socket.EAI_NONAME, f"{host}: name resolution failed (cached)")
+        last_error: Optional[OSError] = None
+        for ip in addresses:
+            try:
+                with metrics.span('connect', kind='tcp', host=host):
+                    return original((ip, port), *args, **kwargs)
+            except OSError as e:
+                last_error = e
+        raise last_error
+
+
+# 进程内共享的 DNS 缓存，main() 开始时安装
+dns_cache = DnsCache()
+
+
 def load_config() -> tuple:
     """加载配置信息"""
     load_dotenv()
@@ -40,53 +563,476 @@ def load_config() -> tuple:
     return urls, cache_time, int(ttl) if ttl else None, int(max_test_sites) if max_test_sites else None
 
 
-def fetch_and_decode_subscription(url: str) -> Optional[Dict[Any, Any]]:
-    """获取并解码订阅源"""
+# BASE58 大数进制转换：使用 decimal 模块（libmpdec 的大数乘除为亚平方复杂度）分治转换，
+# 避免 base58 库逐位 divmod 带来的平方复杂度；小输入直接交给 base58 库处理
+_BASE58_ALPHABET = base58.BITCOIN_ALPHABET
+_BASE58_ENCODE_TABLE = bytes.maketrans(bytes(range(58)), _BASE58_ALPHABET)
+_BASE58_DECODE_TABLE = bytes.maketrans(_BASE58_ALPHABET, bytes(range(58)))
+_BASE58_SMALL_INPUT = 2048
+_BIGNUM_LEAF_DIGITS = 64
+_BIGNUM_CONTEXT = decimal.Context(prec=decimal.MAX_PREC, Emax=decimal.MAX_EMAX, Emin=decimal.MIN_EMIN)
+_BIGNUM_CONTEXT.traps[decimal.Inexact] = True
+
+
+def _bignum_powers(base: int, digit_count: int) -> List[decimal.Decimal]:
+    """返回 [base**(LEAF * 2**j)]，最后一项的平方足以覆盖 digit_count 位"""
+    powers = [_BIGNUM_CONTEXT.power(decimal.Decimal(base), _BIGNUM_LEAF_DIGITS)]
+    while _BIGNUM_LEAF_DIGITS << len(powers) < digit_count:
+        powers.append(_BIGNUM_CONTEXT.multiply(powers[-1], powers[-1]))
+    return powers
+
+
+def _digits_to_decimal(digits: bytes, base: int, powers: List[decimal.Decimal]) -> decimal.Decimal:
+    """把 base 进制的数字序列（高位在前）分治转换为 Decimal 整数"""
+    def convert(lo: int, hi: int) -> decimal.Decimal:
+        if hi - lo <= _BIGNUM_LEAF_DIGITS:
+            if base == 256:
+                return decimal.Decimal(int.from_bytes(digits[lo:hi], 'big'))
+            value = 0
+            for digit in digits[lo:hi]:
+                value = value * base + digit
+            return decimal.Decimal(value)
+        level = (hi - lo - 1).bit_length() - _BIGNUM_LEAF_DIGITS.bit_length()
+        mid = hi - (_BIGNUM_LEAF_DIGITS << level)
+        return _BIGNUM_CONTEXT.add(_BIGNUM_CONTEXT.multiply(convert(lo, mid), powers[level]), convert(mid, hi))
+    return convert(0, len(digits))
+
+
+def _decimal_to_digits(value: decimal.Decimal, base: int, powers: List[decimal.Decimal],
+                       out: bytearray, level: int, pad: bool) -> None:
+    """把 Decimal 整数分治转换为 base 进制数字追加到 out；pad 为真时补足 LEAF * 2**(level+1) 位"""
+    if not pad:
+        while level >= 0 and value < powers[level]:
+            level -= 1
+    if level < 0:
+        number = int(value)
+        if base == 256:
+            length = _BIGNUM_LEAF_DIGITS if pad else (number.bit_length() + 7) // 8
+            out += number.to_bytes(length, 'big')
+            return
+        digits = bytearray()
+        while number:
+            number, digit = divmod(number, base)
+            digits.append(digit)
+        if pad:
+            digits.extend(bytes(_BIGNUM_LEAF_DIGITS - len(digits)))
+        digits.reverse()
+        out += digits
+        return
+    quotient, remainder = _BIGNUM_CONTEXT.divmod(value, powers[level])
+    _decimal_to_digits(quotient, base, powers, out, level - 1, pad)
+    _decimal_to_digits(remainder, base, powers, out, level - 1, True)
+
+
+def base58_encode(data: bytes) -> bytes:
+    """BASE58 编码，输出与 base58.b58encode 逐字节一致，大输入的耗时接近线性增长"""
+    if len(data) <= _BASE58_SMALL_INPUT:
+        return base58.b58encode(data)
+    stripped = data.lstrip(b'\0')
+    zeros = len(data) - len(stripped)
+    if not stripped:
+        return _BASE58_ALPHABET[0:1] * zeros
+    value = _digits_to_decimal(stripped, 256, _bignum_powers(256, len(stripped)))
+    powers = _bignum_powers(58, len(stripped) * 138 // 100 + 2)
+    out = bytearray()
+    _decimal_to_digits(value, 58, powers, out, len(powers) - 1, False)
+    return _BASE58_ALPHABET[0:1] * zeros + bytes(out.translate(_BASE58_ENCODE_TABLE))
+
+
+def base58_decode(text: Union[str, bytes]) -> bytes:
+    """BASE58 解码，结果与 base58.b58decode 逐字节一致，非法字符抛出 ValueError"""
+    text = text.rstrip()
+    if isinstance(text, str):
+        text = text.encode('ascii')
+    if len(text) <= _BASE58_SMALL_INPUT:
+        return base58.b58decode(text)
+    invalid = text.translate(None, _BASE58_ALPHABET)
+    if invalid:
+        raise ValueError("Invalid character {!r}".format(chr(invalid[0])))
+    stripped = text.lstrip(_BASE58_ALPHABET[0:1])
+    zeros = len(text) - len(stripped)
+    if not stripped:
+        return b'\0' * zeros
+    digits = stripped.translate(_BASE58_DECODE_TABLE)
+    value = _digits_to_decimal(digits, 58, _bignum_powers(58, len(digits)))
+    powers = _bignum_powers(256, len(digits) * 75 // 100 + 2)
+    out = bytearray()
+    _decimal_to_digits(value, 256, powers, out, len(powers) - 1, False)
+    return b'\0' * zeros + bytes(out)
+
+
+# 输出格式：pretty 为原有的缩进 JSON，minified 为紧凑 JSON，zlib 为压缩信封
+OUTPUT_FORMATS = ('pretty', 'minified', 'zlib')
+# 压缩信封：魔数 + 1 字节版本号 + 1 字节压缩算法标记，之后是压缩后的紧凑 JSON
+_ENVELOPE_MAGIC = b'TVCF'
+_ENVELOPE_VERSION = 1
+_ENVELOPE_ZLIB = b'Z'
+
+
+def get_output_format() -> str:
+    """读取 OUTPUT_FORMAT 环境变量，默认 pretty"""
+    output_format = (os.getenv('OUTPUT_FORMAT') or 'pretty').strip().lower()
+    if output_format not in OUTPUT_FORMATS:
+        print(f"Error: OUTPUT_FORMAT must be one of {', '.join(OUTPUT_FORMATS)}, got {output_format!r}")
+        sys.exit(1)
+    return output_format
+
+
+def serialize_config(config: Dict[Any, Any], output_format: str = 'pretty') -> bytes:
+    """按输出格式把配置序列化为待 BASE58 编码的字节"""
+    if output_format == 'pretty':
+        return json.dumps(config, ensure_ascii=False, indent=2, sort_keys=True).encode('utf-8')
+    minified = json.dumps(config, ensure_ascii=False, separators=(',', ':'), sort_keys=True).encode('utf-8')
+    if output_format == 'minified':
+        return minified
+    if output_format == 'zlib':
+        return _ENVELOPE_MAGIC + bytes([_ENVELOPE_VERSION]) + _ENVELOPE_ZLIB + zlib.compress(minified, 9)
+    raise ValueError(f"Unknown output format: {output_format}")
+
+
+def unwrap_payload(data: bytes) -> str:
+    """解开压缩信封（如果有），返回 JSON 文本"""
+    if not data.startswith(_ENVELOPE_MAGIC):
+        return data.decode('utf-8')
+    version, algorithm = data[len(_ENVELOPE_MAGIC)], data[len(_ENVELOPE_MAGIC) + 1:len(_ENVELOPE_MAGIC) + 2]
+    if version > _ENVELOPE_VERSION:
+        raise ValueError(f"Unsupported envelope version: {version}")
+    if algorithm != _ENVELOPE_ZLIB:
+        raise ValueError(f"Unsupported envelope compression: {algorithm!r}")
+    return zlib.decompress(data[len(_ENVELOPE_MAGIC) + 2:]).decode('utf-8')
+
+
+def content_hash(data: Any) -> str:
+    """计算内容哈希：字节/字符串直接计算，其它对象按排序后的 JSON 计算"""
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    elif not isinstance(data, bytes):
+        data = json.dumps(data, ensure_ascii=False, sort_keys=True).encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+
+def write_if_changed(path: str, content: str) -> bool:
+    """仅当内容与磁盘上的文件不同时才写入，返回是否写入"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            if f.read() == content:
+                return False
+    except FileNotFoundError:
+        pass
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(content)
+    return True
+
+
+class SubscriptionState:
+    """订阅源的增量状态
+
+    记录每个订阅源的 ETag / Last-Modified 和内容哈希，并保存解码后的 JSON，
+    以便上游返回 304 或内容未变化时跳过下载和解码；同时记录上一次构建的输入哈希。
+    订阅源 URL 来自密钥，索引和数据文件都只按 URL 的 sha1 保存，不落盘 URL 本身。
+    """
+
+    def __init__(self, directory: Optional[str] = None):
+        self.directory = directory or os.path.join(get_cache_dir(), 'subscriptions')
+        self.index_path = os.path.join(self.directory, 'index.json')
+        self._lock = threading.Lock()
+        self.index: Dict[str, Any] = {'subscriptions': {}, 'build': {}}
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                self.index.update(json.load(f))
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            print(f"Warning: ignoring unreadable subscription state {self.index_path}: {e}")
+        # 旧版本的索引以明文 URL 为键，丢弃这些条目，下次保存时不再写回
+        self.index['subscriptions'] = {key: entry for key, entry in self.index['subscriptions'].items()
+                                       if re.fullmatch(r'[0-9a-f]{40}', key)}
+
+    @staticmethod
+    def _key(url: str) -> str:
+        return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+    def _data_path(self, url: str) -> str:
+        return os.path.join(self.directory, self._key(url) + '.json')
+
+    def conditional_headers(self, url: str) -> Dict[str, str]:
+        """根据上次的响应头生成条件请求头"""
+        entry = self.index['subscriptions'].get(self._key(url), {})
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def get_hash(self, url: str) -> Optional[str]:
+        return self.index['subscriptions'].get(self._key(url), {}).get('hash')
+
+    def load(self, url: str) -> Optional[Dict[Any, Any]]:
+        """读取上次保存的解码结果"""
+        try:
+            with open(self._data_path(url), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def update(self, url: str, response: requests.Response, raw_hash: str,
+               json_data: Optional[Dict[Any, Any]] = None) -> None:
+        """记录最新的响应头和内容哈希，提供 json_data 时同时保存解码结果"""
+        if json_data is not None:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self._data_path(url), 'w', encoding='utf-8') as f:
+                json.dump(json_data, f, ensure_ascii=False)
+        with self._lock:
+            self.index['subscriptions'][self._key(url)] = {
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'hash': raw_hash,
+            }
+
+    def is_build_current(self, inputs_hash: str, outputs: List[str]) -> bool:
+        """上次构建的输入哈希相同、输出文件（及上次构建登记的文件）存在且未超过重建间隔时返回 True
+
+        探测结果取决于站点的实时状态而不只是合并结果，因此重建间隔不超过 PROBE_CACHE_MAX_AGE：
+        REBUILD_INTERVAL 默认等于 PROBE_CACHE_MAX_AGE，设置得更大时同样按 PROBE_CACHE_MAX_AGE 计算，
+        两者任一为 0 时每轮都重新探测和构建。
+        """
+        if get_env_bool('FORCE_REBUILD'):
+            return False
+        build = self.index.get('build', {})
+        if build.get('inputs_hash') != inputs_hash:
+            return False
+        if not all(os.path.exists(path) for path in list(outputs) + build.get('outputs', [])):
+            return False
+        probe_max_age = get_env_float('PROBE_CACHE_MAX_AGE', 10800)
+        rebuild_interval = min(get_env_float('REBUILD_INTERVAL', probe_max_age), probe_max_age)
+        return rebuild_interval > 0 and time.time() - build.get('ts', 0) < rebuild_interval
+
+    def record_build(self, inputs_hash: str, outputs: Iterable[str] = ()) -> None:
+        """记录本次构建的输入哈希，outputs 为本次实际写出、之后需要存在的可选文件（如增量）"""
+        self.index['build'] = {'inputs_hash': inputs_hash, 'ts': time.time(),
+                               'outputs': [path for path in outputs if os.path.exists(path)]}
+
+    def save(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = self.index_path + '.tmp'
+        with self._lock, open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.index, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.index_path)
+
+
+_BASE64_ALPHABET = b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/='
+_SNIFF_SAMPLE_SIZE = 4096
+
+
+def detect_payload_format(content: str) -> str:
+    """根据首字符和字符集判断订阅内容的编码，返回 json / base58 / base64 / ambiguous
+
+    先只检查开头的一小段：出现 BASE58 字母表以外的字符即可判定不是 BASE58。
+    BASE58 字母表是 BASE64 字母表的子集，只有全部字符都落在 BASE58 字母表内、
+    且长度恰好可以被 4 整除时才无法区分，此时返回 ambiguous。
+    """
+    if content[:1] in ('{', '['):
+        return 'json'
+    try:
+        sample = content[:_SNIFF_SAMPLE_SIZE].encode('ascii')
+    except UnicodeEncodeError:
+        return 'json'
+    if sample.translate(None, _BASE58_ALPHABET):
+        return 'base64' if not sample.translate(None, _BASE64_ALPHABET + b'\r\n') else 'json'
+    try:
+        data = content.encode('ascii') if len(content) > len(sample) else sample
+    except UnicodeEncodeError:
+        return 'json'
+    if data.translate(None, _BASE58_ALPHABET):
+        return 'base64'
+    return 'ambiguous' if len(data) % 4 == 0 else 'base58'
+
+
+def decode_subscription_content(content: str, source: str = '') -> Any:
+    """按探测到的格式只走一条解码路径，仅在格式无法区分时依次尝试"""
+    payload_format = detect_payload_format(content)
+    if payload_format == 'base58':
+        print(f"Detected BASE58 content from {source}")
+        return json.loads(unwrap_payload(base58_decode(content)))
+    if payload_format == 'base64':
+        print(f"Detected BASE64 content from {source}")
+        return json.loads(unwrap_payload(base64.b64decode(content)))
+    if payload_format == 'json':
+        print(f"Detected plain text content from {source}")
+        return json.loads(content)
+    # 无法区分时先尝试代价低的 BASE64，解码结果不是合法 JSON 再按 BASE58 解码
+    try:
+        json_data = json.loads(unwrap_payload(base64.b64decode(content, validate=True)))
+        print(f"Ambiguous content from {source}, decoded as BASE64")
+        return json_data
+    except (ValueError, zlib.error):
+        pass
+    print(f"Ambiguous content from {source}, decoding as BASE58")
+    return json.loads(unwrap_payload(base58_decode(content)))
+
+
+_decode_pool: Optional[ProcessPoolExecutor] = None
+_decode_pool_lock = threading.Lock()
+
+
+def get_decode_pool() -> Optional[ProcessPoolExecutor]:
+    """获取解码用的共享进程池（第一次使用时创建，常驻模式下跨轮复用）
+
+    进程数为 DECODE_WORKERS，默认 CPU 核数减一（最多 4），为 0 时不使用进程池。
+    """
+    global _decode_pool
+    with _decode_pool_lock:
+        if _decode_pool is None:
+            workers = get_env_int('DECODE_WORKERS', min(4, (os.cpu_count() or 1) - 1))
+            if workers <= 0:
+                return None
+            # spawn 避免在多线程的进程中 fork
+            _decode_pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        return _decode_pool
+
+
+def _decode_in_worker(content: str, source: str) -> tuple:
+    """在解码进程中执行：返回 (解析结果, 日志)，日志由主进程输出"""
+    log = io.StringIO()
+    with redirect_stdout(log):
+        json_data = decode_subscription_content(content, source)
+    return json_data, log.getvalue()
+
+
+def decode_subscription(content: str, source: str = '') -> Any:
+    """解码订阅源内容，不小于 DECODE_PROCESS_THRESHOLD 字节（默认 64 KB）的 BASE58 内容交给进程池解码和解析
+
+    调用线程等待结果期间，其它订阅源的下载和解码继续进行，结果仍按原顺序合并。
+    BASE58 解码是纯 CPU 计算，耗时远大于发送到子进程的开销；明文 JSON 和 BASE64 的解析很快，
+    在主进程中反序列化子进程结果的耗时与直接解析相当，因此始终在本进程中解码（见 benchmark.py decode）。
+    """
+    threshold = get_env_int('DECODE_PROCESS_THRESHOLD', 65536)
+    pool = None
+    if 0 < threshold <= len(content) and detect_payload_format(content) in ('base58', 'ambiguous'):
+        pool = get_decode_pool()
+    if pool is not None:
+        try:
+            with metrics.span('decode', kind='process', source=source, bytes=len(content)):
+                json_data, log = pool.submit(_decode_in_worker, content, source).result()
+            print(log, end='')
+            metrics.incr('subscriptions_decoded_in_pool')
+            return json_data
+        except BrokenProcessPool as e:
+            print(f"Warning: decode pool unavailable ({e}), decoding in-process: {source}")
+    return decode_subscription_content(content, source)
+
+
+def fetch_and_decode_subscription(url: str, session: Optional[requests.Session] = None,
+                                  state: Optional[SubscriptionState] = None) -> Optional[Dict[Any, Any]]:
+    """获取并解码订阅源，提供 state 时使用条件请求并跳过未变化内容的解码"""
+    session = session or get_http_session()
     try:
         print(f"Fetching: {url}")
-        response = requests.get(url, timeout=30)
+        headers = state.conditional_headers(url) if state else {}
+        with metrics.span('subscription', kind='http', url=url) as record:
+            response = session.get(url, timeout=30, headers=headers)
+            record['status'] = response.status_code
+            record['bytes'] = len(response.content)
+        metrics.incr('bytes_downloaded', len(response.content))
+        if response.status_code == 304 and state:
+            cached = state.load(url)
+            if cached is not None:
+                print(f"Not modified (304): {url}")
+                metrics.incr('subscriptions_not_modified')
+                return cached
+            # 本地缓存丢失，重新完整下载
+            with metrics.span('subscription', kind='http', url=url) as record:
+                response = session.get(url, timeout=30)
+                record['status'] = response.status_code
+                record['bytes'] = len(response.content)
+            metrics.incr('bytes_downloaded', len(response.content))
         response.raise_for_status()
         
         content = response.text.strip()
+        raw_hash = content_hash(content)
+        if state and state.get_hash(url) == raw_hash:
+            cached = state.load(url)
+            if cached is not None:
+                print(f"Content unchanged, reusing decoded data: {url}")
+                metrics.incr('subscriptions_unchanged')
+                state.update(url, response, raw_hash)
+                return cached
         
-        # 尝试 BASE58 解码
-        try:
-            decoded_content = base58.b58decode(content).decode('utf-8')
-            print(f"Successfully decoded BASE58 content from {url}")
-        except Exception:
-            # 如果 BASE58 解码失败，尝试 BASE64
-            try:
-                decoded_content = base64.b64decode(content).decode('utf-8')
-                print(f"Successfully decoded BASE64 content from {url}")
-            except Exception:
-                # 如果都失败，假设内容是明文 JSON
-                decoded_content = content
-                print(f"Using plain text content from {url}")
-        
-        # 解析 JSON
-        json_data = json.loads(decoded_content)
+        # 先判断编码格式，再解码并解析 JSON（大内容在进程池中进行）
+        json_data = decode_subscription(content, url)
+        metrics.incr('subscriptions_decoded')
+        if state:
+            state.update(url, response, raw_hash, json_data)
         return json_data
         
     except requests.RequestException as e:
         print(f"Error fetching {url}: {e}")
+        metrics.incr('subscriptions_failed')
         return None
     except json.JSONDecodeError as e:
         print(f"Error parsing JSON from {url}: {e}")
+        metrics.incr('subscriptions_failed')
         return None
     except Exception as e:
         print(f"Unexpected error processing {url}: {e}")
+        metrics.incr('subscriptions_failed')
         return None
 
 
+def iter_subscriptions(urls: Iterable[str], max_workers: Optional[int] = None,
+                       state: Optional[SubscriptionState] = None,
+                       prefetch: Optional[int] = None) -> Iterator[Optional[Dict[Any, Any]]]:
+    """并发获取订阅源，按 urls 的顺序逐个产出解码结果
+
+    最多同时预取 prefetch 个订阅源（默认 FETCH_PREFETCH，未设置时等于并发数），
+    产出后生成器不再持有该结果的引用，调用方合并完即可释放。
+    """
+    urls = iter(urls)
+    session = get_http_session()
+    workers = max(1, max_workers or get_env_int('FETCH_CONCURRENCY', 16))
+    window = max(1, prefetch or get_env_int('FETCH_PREFETCH', workers))
+    start_time = time.time()
+    count = 0
+    with ThreadPoolExecutor(max_workers=min(workers, window)) as executor:
+        pending = deque()
+
+        def submit_next() -> None:
+            url = next(urls, None)
+            if url is not None:
+                pending.append(executor.submit(fetch_and_decode_subscription, url, session, state))
+
+        for _ in range(window):
+            submit_next()
+        while pending:
+            future = pending.popleft()
+            result = future.result()
+            # 队首完成后立即补充下一个，保持预取窗口
+            submit_next()
+            count += 1
+            future = None
+            yield result
+            result = None
+    print(f"Fetched {count} subscriptions in {time.time() - start_time:.1f}s")
+
+
+def fetch_subscriptions(urls: List[str], max_workers: Optional[int] = None,
+                        state: Optional[SubscriptionState] = None) -> List[Optional[Dict[Any, Any]]]:
+    """通过共享会话并发获取所有订阅源，结果顺序与 urls 保持一致"""
+    if not urls:
+        return []
+    workers = min(max_workers or get_env_int('FETCH_CONCURRENCY', 16), len(urls))
+    return list(iter_subscriptions(urls, workers, state, prefetch=len(urls)))
+
+
 def check_api_latency(api_url: str, timeout_ms: int) -> bool:
     """检查 API 延迟是否在可接受范围内"""
     try:
         start_time = time.time()
         # 使用更短的超时时间来避免长时间等待
-        response = requests.head(api_url, timeout=min(5.0, timeout_ms/1000))
-        end_time = time.time()
+        response = get_probe_session().head(api_url, timeout=min(5.0, timeout_ms/1000))
         
-        latency_ms = (end_time - start_time) * 1000
+        latency_ms = response_timing(response, start_time)
         is_fast = latency_ms <= timeout_ms
         print(f"  {api_url[:50]}... - {latency_ms:.0f}ms {'✓' if is_fast else '✗'}")
         return is_fast
@@ -97,17 +1043,769 @@ def check_api_latency(api_url: str, timeout_ms: int) -> bool:
         return False
 
 
-def test_site_latency(api_url: str) -> Optional[float]:
+def test_site_latency(api_url: str, timeout: float = 5.0) -> Optional[float]:
     """测试单个站点的延迟，返回延迟时间或None"""
     try:
         start_time = time.time()
-        requests.head(api_url, timeout=5.0)
-        end_time = time.time()
-        return (end_time - start_time) * 1000
+        response = get_probe_session().head(api_url, timeout=timeout)
+        return response_timing(response, start_time)
     except Exception:
         return None
 
 
+def normalize_api_url(api_url: str) -> str:
+    """规范化 API URL：小写协议和主机名，去掉默认端口和末尾的斜杠"""
+    parsed = urlparse(api_url.strip())
+    scheme = parsed.scheme.lower()
+    host = (parsed.hostname or '').lower()
+    try:
+        port = parsed.port
+    except ValueError:
+        port = None
+    if port is None or (scheme, port) in (('http', 80), ('https', 443)):
+        netloc = host
+    else:
+        netloc = f"{host}:{port}"
+    return urlunparse((scheme, netloc, parsed.path.rstrip('/'), '', parsed.query, ''))
+
+
+def endpoint_key(api_url: str) -> str:
+    """端点键：在规范化 URL 的基础上忽略 http/https 的区别，等价的 API URL 得到相同的键"""
+    return normalize_api_url(api_url).split('://', 1)[-1]
+
+
+class EndpointIndex:
+    """规范化端点与主机索引，每轮运行构建一次
+
+    key_of 记录每个 API URL 对应的端点键，urls_by_endpoint 记录指向同一端点的所有 URL。
+    合并去重和探测都通过它判断端点是否等价。
+    """
+
+    def __init__(self, api_urls: Iterable[str] = ()):
+        self.key_of: Dict[str, str] = {}
+        self.urls_by_endpoint: Dict[str, List[str]] = defaultdict(list)
+        for api_url in api_urls:
+            self.add(api_url)
+
+    def add(self, api_url: str) -> str:
+        """登记 API URL 并返回它的端点键"""
+        key = self.key_of.get(api_url)
+        if key is None:
+            key = endpoint_key(api_url)
+            self.key_of[api_url] = key
+            self.urls_by_endpoint[key].append(api_url)
+        return key
+
+    def has_endpoint(self, api_url: str) -> bool:
+        """是否已登记与 api_url 等价的端点"""
+        key = self.key_of.get(api_url) or endpoint_key(api_url)
+        return key in self.urls_by_endpoint
+
+
+class ProbeCache:
+    """持久化的探测结果缓存
+
+    以端点键（规范化的 API URL，忽略 http/https）为键，按类型（如 probe）保存探测结果。
+    超过有效期的条目视为未命中，条目总数超过上限时淘汰最久未更新的条目。
+    """
+
+    def __init__(self, path: Optional[str] = None, max_age: Optional[float] = None,
+                 max_entries: Optional[int] = None, refresh: Optional[bool] = None):
+        self.path = path or os.path.join(get_cache_dir(), 'probe_cache.json')
+        self.max_age = max_age if max_age is not None else get_env_float('PROBE_CACHE_MAX_AGE', 10800)
+        self.max_entries = max_entries if max_entries is not None else get_env_int('PROBE_CACHE_MAX_ENTRIES', 5000)
+        self.refresh = refresh if refresh is not None else get_env_bool('PROBE_CACHE_REFRESH')
+        self.hits = 0
+        self.misses = 0
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            print(f"Warning: ignoring unreadable probe cache {self.path}: {e}")
+
+    def get(self, kind: str, api_url: str) -> tuple:
+        """查询缓存，返回 (是否命中, 值)"""
+        if not self.refresh and self.max_age > 0:
+            entry = self.entries.get(endpoint_key(api_url), {}).get(kind)
+            if entry is not None and time.time() - entry['ts'] <= self.max_age:
+                self.hits += 1
+                metrics.incr('probe_cache_hits')
+                return True, entry['value']
+        self.misses += 1
+        metrics.incr('probe_cache_misses')
+        return False, None
+
+    def peek(self, kind: str, api_url: str) -> Optional[Any]:
+        """读取缓存值而不检查有效期，也不计入命中统计（用于排序和预算用尽时的兜底）"""
+        entry = self.entries.get(endpoint_key(api_url), {}).get(kind)
+        return entry['value'] if entry is not None else None
+
+    def put(self, kind: str, api_url: str, value: Any) -> None:
+        self.entries.setdefault(endpoint_key(api_url), {})[kind] = {'value': value, 'ts': time.time()}
+
+    def save(self) -> None:
+        """淘汰多余条目后原子写回磁盘"""
+        if self.max_entries > 0 and len(self.entries) > self.max_entries:
+            newest_first = sorted(self.entries.items(),
+                                  key=lambda item: max(e['ts'] for e in item[1].values()), reverse=True)
+            self.entries = dict(newest_first[:self.max_entries])
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+        print(f"Probe cache saved: {len(self.entries)} entries, {self.hits} hits, {self.misses} misses")
+        self.hits = self.misses = 0
+
+
+class CircuitBreaker:
+    """跨运行的站点熔断器
+
+    以端点键记录连续失败（请求无响应）的次数。连续失败达到 BREAKER_THRESHOLD 次后熔断，
+    之后的若干轮运行直接跳过探测，跳过的轮数从 BREAKER_BASE_SKIP 开始按失败次数指数增长，
+    最多 BREAKER_MAX_SKIP 轮。跳过期满后进入半开状态：先发起一次廉价的 HEAD 请求，
+    有响应才进行完整探测，探测成功即清除失败记录。BREAKER_THRESHOLD 为 0 时关闭熔断。
+    """
+
+    # 超过该时间（秒）未出现的站点记录会被清理
+    RETENTION = 30 * 86400
+
+    def __init__(self, path: Optional[str] = None, threshold: Optional[int] = None,
+                 base_skip: Optional[int] = None, max_skip: Optional[int] = None):
+        self.path = path or os.path.join(get_cache_dir(), 'circuit_breaker.json')
+        self.threshold = threshold if threshold is not None else get_env_int('BREAKER_THRESHOLD', 3)
+        self.base_skip = max(1, base_skip if base_skip is not None else get_env_int('BREAKER_BASE_SKIP', 1))
+        self.max_skip = max(self.base_skip, max_skip if max_skip is not None else get_env_int('BREAKER_MAX_SKIP', 32))
+        self._lock = threading.Lock()
+        # 本轮运行中每个端点的决策，保证每轮只消耗一次跳过次数
+        self.decisions: Dict[str, str] = {}
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            print(f"Warning: ignoring unreadable circuit breaker state {self.path}: {e}")
+
+    @property
+    def enabled(self) -> bool:
+        return self.threshold > 0
+
+    def decide(self, api_url: str) -> str:
+        """返回本轮对该端点的决策：closed（正常探测）、open（跳过）、half_open（先做 HEAD 检查）"""
+        key = endpoint_key(api_url)
+        with self._lock:
+            if key in self.decisions:
+                return self.decisions[key]
+            entry = self.entries.get(key)
+            if not self.enabled or entry is None or entry['failures'] < self.threshold:
+                decision = 'closed'
+            elif entry.get('skip_remaining', 0) > 0:
+                entry['skip_remaining'] -= 1
+                decision = 'open'
+            else:
+                decision = 'half_open'
+            if entry is not None:
+                entry['ts'] = time.time()
+            self.decisions[key] = decision
+            return decision
+
+    def record(self, api_url: str, success: bool) -> None:
+        """记录一次探测结果：成功时清除失败记录，失败时累加并在达到阈值后计算跳过轮数"""
+        if not self.enabled:
+            return
+        key = endpoint_key(api_url)
+        with self._lock:
+            if success:
+                self.entries.pop(key, None)
+                return
+            entry = self.entries.setdefault(key, {'failures': 0, 'skip_remaining': 0})
+            entry['failures'] += 1
+            entry['ts'] = time.time()
+            if entry['failures'] >= self.threshold:
+                entry['skip_remaining'] = min(self.max_skip,
+                                              self.base_skip << min(entry['failures'] - self.threshold, 30))
+
+    def describe(self, api_url: str) -> Dict[str, Any]:
+        return dict(self.entries.get(endpoint_key(api_url), {}))
+
+    def save(self) -> None:
+        """清理长期未出现的记录后原子写回磁盘"""
+        now = time.time()
+        with self._lock:
+            self.entries = {key: entry for key, entry in self.entries.items()
+                            if now - entry.get('ts', now) <= self.RETENTION}
+            opened = sum(1 for entry in self.entries.values() if entry['failures'] >= self.threshold)
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.entries, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+            # 本轮运行结束，常驻模式下一轮重新决策
+            self.decisions.clear()
+        print(f"Circuit breaker saved: {len(self.entries)} failing endpoints, {opened} open")
+
+
+class LatencyHistory:
+    """跨运行的端点延迟历史
+
+    以端点键为每个端点保存最近 LATENCY_HISTORY_SIZE 次真实探测的延迟（环形缓冲，失败记为 null），
+    并维护成功样本的 EWMA（平滑系数 LATENCY_EWMA_ALPHA）。排序和去重使用 EWMA 而不是单次样本，
+    避免排名在各轮之间来回跳动。
+
+    最近 LATENCY_STABLE_SAMPLES 次探测全部成功、且 p95 不超过 p50 的 (1 + LATENCY_STABLE_SPREAD) 倍的端点视为稳定，
+    上一次采样不超过 LATENCY_STABLE_MAX_AGE 秒时本轮不再探测，直接沿用缓存的结果。
+    LATENCY_HISTORY_SIZE 为 0 时关闭历史记录。
+    """
+
+    # 超过该时间（秒）未采样的端点记录会被清理
+    RETENTION = 30 * 86400
+
+    def __init__(self, path: Optional[str] = None, size: Optional[int] = None, alpha: Optional[float] = None,
+                 stable_samples: Optional[int] = None, stable_spread: Optional[float] = None,
+                 stable_max_age: Optional[float] = None):
+        self.path = path or os.path.join(get_cache_dir(), 'latency_history.json')
+        self.size = max(0, size if size is not None else get_env_int('LATENCY_HISTORY_SIZE', 20))
+        self.alpha = min(1.0, max(0.01, alpha if alpha is not None else get_env_float('LATENCY_EWMA_ALPHA', 0.3)))
+        self.stable_samples = max(2, stable_samples if stable_samples is not None
+                                  else get_env_int('LATENCY_STABLE_SAMPLES', 5))
+        self.stable_spread = stable_spread if stable_spread is not None else get_env_float('LATENCY_STABLE_SPREAD', 0.5)
+        self.stable_max_age = stable_max_age if stable_max_age is not None else get_env_float('LATENCY_STABLE_MAX_AGE', 86400)
+        self._lock = threading.Lock()
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            print(f"Warning: ignoring unreadable latency history {self.path}: {e}")
+
+    @property
+    def enabled(self) -> bool:
+        return self.size > 0
+
+    def record(self, api_url: str, latency: Optional[float]) -> None:
+        """记录一次真实探测的延迟（毫秒），None 表示请求失败"""
+        if not self.enabled:
+            return
+        key = endpoint_key(api_url)
+        with self._lock:
+            entry = self.entries.setdefault(key, {'samples': [], 'ewma': None})
+            entry['samples'].append(None if latency is None else round(latency, 1))
+            del entry['samples'][:-self.size]
+            if latency is not None:
+                ewma = entry['ewma']
+                entry['ewma'] = round(latency if ewma is None else ewma + self.alpha * (latency - ewma), 1)
+            entry['ts'] = time.time()
+
+    @staticmethod
+    def _percentile(ordered: List[float], q: float) -> float:
+        """最近秩法计算百分位数，ordered 需已排序且非空"""
+        return ordered[max(0, min(len(ordered) - 1, int(q * len(ordered) + 0.999999) - 1))]
+
+    def stats(self, api_url: str) -> Optional[Dict[str, Any]]:
+        """返回 {'ewma', 'p50', 'p95', 'samples', 'failures'}，没有成功样本时返回 None"""
+        with self._lock:
+            entry = self.entries.get(endpoint_key(api_url))
+            if not self.enabled or entry is None or entry['ewma'] is None:
+                return None
+            samples = list(entry['samples'])
+            ewma = entry['ewma']
+        ordered = sorted(sample for sample in samples if sample is not None)
+        return {'ewma': ewma, 'p50': self._percentile(ordered, 0.5), 'p95': self._percentile(ordered, 0.95),
+                'samples': len(samples), 'failures': len(samples) - len(ordered)}
+
+    def smoothed(self, api_url: str, latency: Optional[float]) -> Optional[float]:
+        """本轮探测成功时返回用于排序的 EWMA 延迟，失败或没有历史时原样返回"""
+        if latency is None:
+            return None
+        stats = self.stats(api_url)
+        return latency if stats is None else stats['ewma']
+
+    def is_stable(self, api_url: str) -> bool:
+        """最近的探测全部成功、延迟分布集中且采样不久的端点本轮可以不探测"""
+        if not self.enabled or self.stable_max_age <= 0:
+            return False
+        with self._lock:
+            entry = self.entries.get(endpoint_key(api_url))
+            if entry is None or time.time() - entry.get('ts', 0) > self.stable_max_age:
+                return False
+            recent = entry['samples'][-self.stable_samples:]
+        if len(recent) < self.stable_samples or any(sample is None for sample in recent):
+            return False
+        stats = self.stats(api_url)
+        return stats is not None and stats['p95'] <= stats['p50'] * (1 + self.stable_spread)
+
+    def save(self) -> None:
+        """清理长期未采样的记录后原子写回磁盘"""
+        if not self.enabled:
+            return
+        now = time.time()
+        with self._lock:
+            self.entries = {key: entry for key, entry in self.entries.items()
+                            if now - entry.get('ts', now) <= self.RETENTION}
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.entries, f, ensure_ascii=False, separators=(',', ':'))
+            os.replace(tmp_path, self.path)
+        print(f"Latency history saved: {len(self.entries)} endpoints")
+
+
+class ProbeEngine:
+    """并发探测引擎：同时限制全局并发数和单个主机的并发数"""
+
+    def __init__(self, max_workers: Optional[int] = None, per_host: Optional[int] = None):
+        self.max_workers = max(1, max_workers or get_env_int('PROBE_CONCURRENCY', 32))
+        self.per_host = max(1, per_host or get_env_int('PROBE_PER_HOST', 4))
+        self._host_semaphores: Dict[str, threading.Semaphore] = {}
+        self._lock = threading.Lock()
+
+    def _host_semaphore(self, url: str) -> threading.Semaphore:
+        host = (urlparse(url).hostname or '').lower()
+        with self._lock:
+            if host not in self._host_semaphores:
+                self._host_semaphores[host] = threading.Semaphore(self.per_host)
+            return self._host_semaphores[host]
+
+    def _run(self, func: Callable[..., Any], url: str, *args: Any) -> Any:
+        with self._host_semaphore(url):
+            return func(url, *args)
+
+    def map(self, func: Callable[[str], Any], urls: Iterable[str]) -> Dict[str, Any]:
+        """对所有 URL 并发执行 func，返回 {url: 结果}，相同 URL 只执行一次"""
+        unique_urls = list(dict.fromkeys(urls))
+        if not unique_urls:
+            return {}
+        workers = min(self.max_workers, len(unique_urls))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(lambda url: self._run(func, url), unique_urls)
+            return dict(zip(unique_urls, results))
+
+    def race(self, candidates: Dict[str, List[str]], func: Callable[[str, threading.Event], Any],
+             accept: Callable[[Any], bool] = bool, hedge_delay: float = 0.0) -> Dict[str, tuple]:
+        """每个 key 的候选 URL 竞速执行 func，第一个被 accept 认可的结果获胜并取消其余候选
+
+        第一个候选立即发起；其余候选在前一个候选失败、或开始执行 hedge_delay 秒后仍无结果时才发起，
+        hedge_delay 为 0 时所有候选同时发起。返回 {key: (获胜的 URL, 结果)}，
+        全部失败时为 (None, 第一个候选的结果)。func 应在 cancelled 被设置后尽快返回。
+        """
+        outcomes: Dict[str, tuple] = {}
+        if not candidates:
+            return outcomes
+        cancel_events = {key: threading.Event() for key in candidates}
+        next_index = {key: 0 for key in candidates}
+        started_at: Dict[str, float] = {}
+        first_results: Dict[str, Any] = {}
+        active: Dict[str, set] = {key: set() for key in candidates}
+        futures: Dict[Any, tuple] = {}
+
+        def run_candidate(key: str, url: str) -> Any:
+            with self._host_semaphore(url):
+                started_at[key] = time.time()
+                return func(url, cancel_events[key])
+
+        workers = min(self.max_workers, sum(len(urls) for urls in candidates.values()))
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            def launch(key: str) -> None:
+                url = candidates[key][next_index[key]]
+                next_index[key] += 1
+                future = executor.submit(run_candidate, key, url)
+                futures[future] = (key, url)
+                active[key].add(future)
+
+            for key, urls in candidates.items():
+                if not urls:
+                    outcomes[key] = (None, None)
+                    continue
+                launch(key)
+                while hedge_delay <= 0 and next_index[key] < len(urls):
+                    launch(key)
+
+            while futures:
+                timeout = None
+                if hedge_delay > 0:
+                    deadlines = [started_at[key] + hedge_delay for key in candidates
+                                 if key not in outcomes and key in started_at
+                                 and next_index[key] < len(candidates[key])]
+                    if deadlines:
+                        timeout = max(0.0, min(deadlines) - time.time())
+                done, _ = wait(list(futures), timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    key, url = futures.pop(future)
+                    active[key].discard(future)
+                    if key in outcomes or future.cancelled():
+                        continue
+                    result = None if future.exception() else future.result()
+                    if url == candidates[key][0]:
+                        first_results[key] = result
+                    if accept(result):
+                        outcomes[key] = (url, result)
+                        cancel_events[key].set()
+                        for other in active[key]:
+                            other.cancel()
+                    elif next_index[key] < len(candidates[key]):
+                        launch(key)
+                    elif not active[key]:
+                        outcomes[key] = (None, first_results.get(key))
+                # 对等待过久仍无结果的站点发起对冲请求
+                if hedge_delay > 0:
+                    now = time.time()
+                    for key in candidates:
+                        if (key not in outcomes and key in started_at and next_index[key] < len(candidates[key])
+                                and now - started_at[key] >= hedge_delay):
+                            metrics.incr('probe_hedges')
+                            launch(key)
+        return outcomes
+
+
+# 默认使用只返回列表字段的 ac=list 查询，不含 ac=detail 的完整剧集列表；可通过 PROBE_QUERY 修改
+SEARCH_PARAMS = {'ac': "list", 'wd': "庆余年"}
+PROBE_TIMEOUT = 5.0
+# 流式验证：每次读取的块大小、JSON 结构扫描规则，以及顶层键之后 code == 1 和非空 list 的检测规则
+VALIDATE_CHUNK_SIZE = 4096
+_JSON_TOKEN_PATTERN = re.compile(rb'"(?:[^"\\]|\\.)*"|[{}\[\]]|"')
+_VALID_CODE_PATTERN = re.compile(rb'\s*:\s*1\s*[,}]')
+_NONEMPTY_LIST_PATTERN = re.compile(rb'\s*:\s*\[\s*\{')
+# 顶层键之后至少已读到的字节数，不足时等读到下一块再判断它的值
+_VALIDATE_LOOKAHEAD = 64
+# 剩余预算低于该秒数时不再发起新的探测
+PROBE_MIN_TIMEOUT = 0.5
+# 熔断半开检查（HEAD 请求）的超时
+HALF_OPEN_TIMEOUT = 2.0
+
+
+def get_search_params() -> Dict[str, str]:
+    """探测使用的查询参数，PROBE_QUERY 形如 ac=detail&wd=庆余年"""
+    query = os.getenv('PROBE_QUERY')
+    return dict(parse_qsl(query)) if query else SEARCH_PARAMS
+
+
+def get_probe_params() -> Dict[str, Any]:
+    """影响探测结果的设置（查询参数和验证读取上限），用于判断是否需要重新构建"""
+    return {'query': get_search_params(), 'validate_max_bytes': get_env_int('VALIDATE_MAX_BYTES', 65536)}
+
+
+def validate_search_response(response: requests.Response, max_bytes: Optional[int] = None) -> tuple:
+    """流式读取搜索响应，验证 code == 1 且 list 非空，返回 (是否有效, 读取的字节数)
+
+    边读边跟踪括号深度（跳过字符串内容），只在顶层对象中识别 "code": 1 和非空 "list"，
+    两者都出现时立即停止读取；嵌套对象中的 code / list 不计入。
+    快速判断无法确定时（如读完了整个响应）按 JSON 完整解析；读取量达到 max_bytes（VALIDATE_MAX_BYTES，
+    0 表示不限制）仍未能证明有效时停止并判定无效。
+    """
+    if max_bytes is None:
+        max_bytes = get_env_int('VALIDATE_MAX_BYTES', 65536)
+    if response.status_code != 200:
+        return False, 0
+    buffer = bytearray()
+    depth = scanned = 0
+    code_ok = list_ok = False
+    for chunk in response.iter_content(chunk_size=VALIDATE_CHUNK_SIZE):
+        buffer += chunk
+        for token in _JSON_TOKEN_PATTERN.finditer(buffer, scanned):
+            value = token.group()
+            if value in (b'{', b'['):
+                depth += 1
+            elif value in (b'}', b']'):
+                depth -= 1
+            elif value == b'"' or (depth == 1 and value in (b'"code"', b'"list"')
+                                   and len(buffer) - token.end() < _VALIDATE_LOOKAHEAD):
+                # 字符串或顶层键的值尚未读完，从这里开始等下一块
+                scanned = token.start()
+                break
+            elif depth == 1 and value == b'"code"':
+                code_ok = bool(_VALID_CODE_PATTERN.match(buffer, token.end()))
+            elif depth == 1 and value == b'"list"':
+                list_ok = list_ok or bool(_NONEMPTY_LIST_PATTERN.match(buffer, token.end()))
+            scanned = token.end()
+        else:
+            scanned = len(buffer)
+        if code_ok and list_ok:
+            return True, len(buffer)
+        if max_bytes and len(buffer) >= max_bytes:
+            return False, len(buffer)
+    try:
+        data = json.loads(bytes(buffer))
+    except ValueError:
+        return False, len(buffer)
+    return isinstance(data, dict) and data.get('code') == 1 and bool(data.get('list')), len(buffer)
+
+
+def probe_search_api(api_url: str, cancelled: Optional[threading.Event] = None,
+                     timeout: float = PROBE_TIMEOUT) -> Dict[str, Any]:
+    """发起一次真实的搜索请求，测量首字节时间（ttfb）和完成验证的耗时（latency），并记录读取的字节数"""
+    result = {'latency': None, 'ttfb': None, 'valid': False, 'bytes': 0}
+    if cancelled is not None and cancelled.is_set():
+        return result
+    metrics.incr('probes_issued')
+    try:
+        with metrics.span('probe', kind='http', url=api_url) as record:
+            start_time = time.time()
+            with get_probe_session().get(api_url, params=get_search_params(), timeout=timeout,
+                                         stream=True) as response:
+                result['ttfb'] = response_timing(response, start_time, full=False)
+                record['status'] = response.status_code
+                if cancelled is not None and cancelled.is_set():
+                    record['cancelled'] = True
+                    return result
+                result['valid'], result['bytes'] = validate_search_response(response)
+                result['latency'] = response_timing(response, start_time)
+                record['bytes'] = result['bytes']
+                metrics.incr('bytes_downloaded', result['bytes'])
+                metrics.incr('probe_bytes', result['bytes'])
+    except requests.Timeout:
+        metrics.incr('probe_timeouts')
+    except Exception:
+        metrics.incr('probe_errors')
+    if result['valid']:
+        metrics.incr('probes_valid')
+    return result
+
+
+def probe_result_url(api_url: str, result: Optional[Dict[str, Any]]) -> Optional[str]:
+    """根据探测结果返回验证通过的 URL（原始 URL 或 /at/json/ 变体），未通过时返回 None"""
+    variant = (result or {}).get('variant')
+    if variant == 'original':
+        return api_url
+    if variant == 'at_json':
+        return api_url.rstrip('/') + '/at/json/'
+    return None
+
+
+class SiteProber:
+    """统一探测：每个端点只发起一次真实搜索请求，结果同时用于 TTL 排序和 stream.js 验证
+
+    原始 URL 验证失败、或 PROBE_HEDGE_DELAY 秒内没有结果时，才对 /at/json/ 变体发起请求。
+    同一轮运行中等价的 API URL（同一端点键）只探测一次并共享结果，未过期的结果直接从缓存读取。
+
+    设置 PROBE_BUDGET_SECONDS 时，从第一次探测开始计时，所有探测共享这一时间预算：
+    单次探测的超时随截止时间临近而缩短，预算用尽后排队中的探测不再发起，
+    这些端点使用过期的缓存结果，没有缓存时标记为 skipped。
+
+    提供 breaker 时，持续失败的端点按熔断器的决策跳过探测，视为请求失败。
+
+    安装了 DNS 缓存时，主机名无法解析的端点直接记为失败，不发起 HTTP 请求。
+
+    提供 history 时，每次真实探测的延迟都记入历史，latencies 返回平滑后的 EWMA 延迟；
+    历史稳定的端点在缓存过期后仍沿用缓存结果，把探测预算留给排名不确定的端点。
+    """
+
+    def __init__(self, engine: Optional[ProbeEngine] = None, cache: Optional[ProbeCache] = None,
+                 hedge_delay: Optional[float] = None, index: Optional[EndpointIndex] = None,
+                 budget: Optional[float] = None, breaker: Optional[CircuitBreaker] = None,
+                 history: Optional[LatencyHistory] = None):
+        self.engine = engine or ProbeEngine()
+        self.cache = cache
+        self.breaker = breaker
+        self.history = history
+        self.hedge_delay = hedge_delay if hedge_delay is not None else get_env_float('PROBE_HEDGE_DELAY', 1.0)
+        self.index = index or EndpointIndex()
+        self.budget = budget if budget is not None else get_env_float('PROBE_BUDGET_SECONDS', 0)
+        self.deadline: Optional[float] = None
+        self.results: Dict[str, Dict[str, Any]] = {}
+        # 因预算用尽而未测试的端点键，本轮不再尝试
+        self.unprobed: set = set()
+
+    def previous_latency(self, api_url: str) -> Optional[float]:
+        """本轮或缓存中（不论是否过期）记录的上一次延迟"""
+        result = self.results.get(self.index.add(api_url))
+        if result is None and self.cache:
+            result = self.cache.peek('probe', api_url)
+        return (result or {}).get('latency')
+
+    def _apply_breaker(self, to_probe: Dict[str, str]) -> Dict[str, str]:
+        """按熔断器的决策筛选需要完整探测的端点，被跳过的端点直接记为失败"""
+        decisions = {key: self.breaker.decide(api_url) for key, api_url in to_probe.items()}
+        half_open = [to_probe[key] for key, decision in decisions.items() if decision == 'half_open']
+        alive = self.engine.map(lambda url: test_site_latency(url, HALF_OPEN_TIMEOUT), half_open) if half_open else {}
+        allowed: Dict[str, str] = {}
+        skipped = recovered = 0
+        for key, api_url in to_probe.items():
+            decision = decisions[key]
+            if decision == 'half_open':
+                metrics.incr('breaker_half_open')
+                if alive[api_url] is None:
+                    self.breaker.record(api_url, False)
+                    decision = 'open'
+                else:
+                    recovered += 1
+            if decision != 'open':
+                allowed[key] = api_url
+                continue
+            entry = self.breaker.describe(api_url)
+            print(f"  熔断跳过: {api_url} (连续失败 {entry.get('failures')} 次，之后还将跳过 {entry.get('skip_remaining')} 轮)")
+            metrics.event('breaker_skip', url=api_url, half_open=decisions[key] == 'half_open', **entry)
+            self.results[key] = {'latency': None, 'ttfb': None, 'valid': False, 'variant': None, 'breaker': 'open'}
+            skipped += 1
+        if skipped or half_open:
+            metrics.incr('breaker_skipped', skipped)
+            metrics.incr('breaker_recovered', recovered)
+            print(f"熔断：跳过 {skipped} 个持续失败的端点，半开检查 {len(half_open)} 个，其中 {recovered} 个有响应")
+        return allowed
+
+    def _drop_unresolvable(self, to_probe: Dict[str, str]) -> Dict[str, str]:
+        """补充解析尚未缓存的主机名，无法解析的端点直接记为失败，不发起 HTTP 请求"""
+        dns_cache.prefetch(url_host(api_url) for api_url in to_probe.values())
+        allowed: Dict[str, str] = {}
+        for key, api_url in to_probe.items():
+            if not dns_cache.is_unresolvable(url_host(api_url)):
+                allowed[key] = api_url
+                continue
+            self.results[key] = {'latency': None, 'ttfb': None, 'valid': False, 'variant': None, 'dns': 'failed'}
+            if self.breaker:
+                self.breaker.record(api_url, False)
+            if self.history:
+                self.history.record(api_url, None)
+        dropped = len(to_probe) - len(allowed)
+        if dropped:
+            metrics.incr('dns_dropped', dropped)
+            print(f"DNS 解析失败，跳过 {dropped} 个端点")
+        return allowed
+
+    def _probe_within_budget(self, api_url: str, cancelled: threading.Event) -> Dict[str, Any]:
+        if self.deadline is None:
+            return probe_search_api(api_url, cancelled)
+        remaining = self.deadline - time.time()
+        if remaining < PROBE_MIN_TIMEOUT:
+            return {'latency': None, 'ttfb': None, 'valid': False, 'skipped': True}
+        return probe_search_api(api_url, cancelled, timeout=min(PROBE_TIMEOUT, remaining))
+
+    def probe(self, api_urls: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        """返回 {api_url: {'latency', 'ttfb', 'valid', 'variant'}}，latency 为 None 表示请求失败"""
+        wanted = list(dict.fromkeys(api_urls))
+        keys = {api_url: self.index.add(api_url) for api_url in wanted}
+        to_probe: Dict[str, str] = {}
+        cached_count = stable_count = 0
+        for api_url in wanted:
+            key = keys[api_url]
+            if key in self.results or key in to_probe or key in self.unprobed:
+                continue
+            hit, result = self.cache.get('probe', api_url) if self.cache else (False, None)
+            if hit:
+                self.results[key] = result
+                cached_count += 1
+                continue
+            # 历史稳定的端点沿用过期的缓存结果，本轮不再采样
+            stale = self.cache.peek('probe', api_url) if self.cache and not self.cache.refresh else None
+            if stale and stale.get('valid') and self.history and self.history.is_stable(api_url):
+                self.results[key] = {**stale, 'stable': True}
+                stable_count += 1
+            else:
+                to_probe[key] = api_url
+        if len(set(keys.values())) < len(wanted):
+            print(f"{len(wanted)} 个 API 指向 {len(set(keys.values()))} 个不同端点，等价端点只探测一次")
+        if cached_count:
+            print(f"缓存命中 {cached_count} 个端点的探测结果")
+        if stable_count:
+            metrics.incr('probes_skipped_stable', stable_count)
+            print(f"{stable_count} 个端点的延迟历史稳定，本轮沿用缓存结果")
+        if to_probe and dns_cache.enabled:
+            to_probe = self._drop_unresolvable(to_probe)
+        if to_probe and self.breaker and self.breaker.enabled:
+            to_probe = self._apply_breaker(to_probe)
+        if to_probe:
+            start_time = time.time()
+            if self.budget > 0 and self.deadline is None:
+                self.deadline = start_time + self.budget
+            # 候选按传入顺序提交，预算有限时排在前面的端点先探测
+            candidates = {key: [api_url, api_url.rstrip('/') + '/at/json/'] for key, api_url in to_probe.items()}
+            outcomes = self.engine.race(candidates, self._probe_within_budget,
+                                        accept=lambda r: bool(r and r['valid']), hedge_delay=self.hedge_delay)
+            stale_count = 0
+            unprobed = set()
+            for key, (winner, result) in outcomes.items():
+                api_url = to_probe[key]
+                if result and result.get('skipped'):
+                    stale = self.cache.peek('probe', api_url) if self.cache else None
+                    if stale is None:
+                        unprobed.add(key)
+                    else:
+                        self.results[key] = {**stale, 'stale': True}
+                        stale_count += 1
+                    continue
+                result = dict(result or {'latency': None, 'ttfb': None, 'valid': False})
+                result['variant'] = None if winner is None else ('original' if winner == api_url else 'at_json')
+                self.results[key] = result
+                if self.cache:
+                    self.cache.put('probe', api_url, result)
+                if self.breaker:
+                    self.breaker.record(api_url, result['latency'] is not None)
+                if self.history:
+                    self.history.record(api_url, result['latency'])
+            probed_count = len(to_probe) - stale_count - len(unprobed)
+            bytes_read = sum(self.results[key].get('bytes') or 0 for key in to_probe
+                             if key in self.results and not self.results[key].get('stale'))
+            print(f"并发探测 {probed_count} 个端点完成，"
+                  f"耗时 {time.time() - start_time:.1f}s "
+                  f"(并发 {self.engine.max_workers}，单主机 {self.engine.per_host})，"
+                  f"读取 {bytes_read / 1024:.1f} KB（平均每个端点 {bytes_read / 1024 / max(1, probed_count):.1f} KB）")
+            if stale_count or unprobed:
+                metrics.incr('probes_skipped_budget', stale_count + len(unprobed))
+                print(f"探测时间预算 ({self.budget:g}s) 用尽：{stale_count} 个端点使用过期缓存结果，"
+                      f"{len(unprobed)} 个端点未测试")
+            self.unprobed |= unprobed
+        skipped = {'latency': None, 'ttfb': None, 'valid': False, 'variant': None, 'skipped': True}
+        return {api_url: skipped if keys[api_url] in self.unprobed else self.results[keys[api_url]]
+                for api_url in wanted}
+
+    def latencies(self, api_urls: Iterable[str]) -> Dict[str, Optional[float]]:
+        """返回 {api_url: 搜索请求总耗时或None}，因时间预算用尽而未测试的站点不在结果中
+
+        有延迟历史时，本轮可用的站点返回历史 EWMA 延迟，本轮失败的站点仍为 None。
+        """
+        results = self.probe(api_urls)
+        if self.history is None:
+            return {api_url: result['latency'] for api_url, result in results.items() if not result.get('skipped')}
+        return {api_url: self.history.smoothed(api_url, result['latency']) for api_url, result in results.items()
+                if not result.get('skipped')}
+
+
+def select_sites_to_test(name_groups: Dict[str, List['SiteRecord']], max_test: Optional[int]) -> List[str]:
+    """按原有的测试上限规则，预先计算本轮需要测试的 API 列表"""
+    api_urls = []
+    tested_count = 0
+    for sites in name_groups.values():
+        if max_test and tested_count >= max_test:
+            continue
+        if len(sites) == 1:
+            if 'api' in sites[0].site:
+                tested_count += 1
+                api_urls.append(sites[0].site['api'])
+            continue
+        # 重复组中先测试豆瓣资源，再测试非豆瓣资源
+        for group in ([s for s in sites if s.is_douban], [s for s in sites if not s.is_douban]):
+            for record in group:
+                if max_test and tested_count >= max_test:
+                    break
+                if 'api' in record.site:
+                    tested_count += 1
+                    api_urls.append(record.site['api'])
+    return api_urls
+
+
+def order_probes_by_value(name_groups: Dict[str, List['SiteRecord']], api_urls: List[str],
+                          prober: SiteProber) -> List[str]:
+    """按探测的预期价值排序：豆瓣资源、重复组（需要比较延迟才能去重）、其余站点，同一档内上次延迟低的优先"""
+    tiers: Dict[str, int] = {}
+    for sites in name_groups.values():
+        for record in sites:
+            if 'api' in record.site:
+                tier = 0 if record.is_douban else (1 if len(sites) > 1 else 2)
+                tiers[record.site['api']] = min(tier, tiers.get(record.site['api'], 2))
+    
+    def expected_value(api_url: str) -> tuple:
+        previous = prober.previous_latency(api_url)
+        return tiers.get(api_url, 2), previous if previous is not None else float('inf')
+    
+    return sorted(api_urls, key=expected_value)
+
+
 def is_douban_resource(site: Dict[Any, Any]) -> bool:
     """判断是否为豆瓣资源"""
     # 检查name字段是否包含"豆瓣"
@@ -125,8 +1823,163 @@ def is_douban_resource(site: Dict[Any, Any]) -> bool:
     return False
 
 
-def remove_prefixes_and_filter_sites(json_data: Dict[Any, Any], ttl_ms: Optional[int] = None, max_test: Optional[int] = None) -> Dict[Any, Any]:
-    """去除前缀、去重、测试延迟并按ttl排序，同时确保保留豆瓣资源"""
+def url_host(api_url: str) -> str:
+    """小写主机名；常见的 scheme://host[:port]/path 形式直接切分字符串，比 urlparse 快得多"""
+    scheme, _, rest = api_url.partition('://')
+    netloc = rest.split('/', 1)[0].split('?', 1)[0]
+    if not rest or '@' in netloc or '[' in netloc:
+        return (urlparse(api_url).hostname or '').lower()
+    return netloc.split(':', 1)[0].lower()
+
+
+class NameNormalizer:
+    """把去前缀后的站点名称映射为规范化的分组键，重复组按分组键构建（一次遍历，不做两两比较）
+
+    规则依次为：NFKC 归一化（全角转半角）并 casefold；去掉 emoji、标点、空白和其它符号；
+    反复去掉 NAME_DROP_SUFFIXES 中的后缀（默认 资源、点播、采集网、资源网、采集）；
+    开启 NAME_DROP_LATIN 时，剩余部分含有中文则去掉其中的英文字母（如 wujinapi无尽 -> 无尽）。
+    这一步会把 TK影视、OK影视 这类只靠英文区分的名称并为一组，因此默认关闭。
+    任一步骤得到空字符串时保留上一步的结果。NAME_NORMALIZE 为 0 时直接使用去前缀后的名称。
+    """
+
+    DEFAULT_SUFFIXES = ('资源', '点播', '采集网', '资源网', '采集')
+
+    def __init__(self, enabled: Optional[bool] = None, suffixes: Optional[Iterable[str]] = None,
+                 drop_latin: Optional[bool] = None):
+        self.enabled = enabled if enabled is not None else get_env_bool('NAME_NORMALIZE', True)
+        self.drop_latin = drop_latin if drop_latin is not None else get_env_bool('NAME_DROP_LATIN', False)
+        if suffixes is None:
+            configured = os.getenv('NAME_DROP_SUFFIXES')
+            suffixes = configured.split(',') if configured is not None else self.DEFAULT_SUFFIXES
+        # 后缀同样规范化，较长的后缀优先匹配
+        # 按（长度降序, 字符串）的全序排列，保证 rules() 及依赖它的输入哈希在不同进程间一致
+        folded = dict.fromkeys(self._fold(suffix) for suffix in suffixes if suffix.strip())
+        self.suffixes = sorted((suffix for suffix in folded if suffix), key=lambda suffix: (-len(suffix), suffix))
+        self._keys: Dict[str, str] = {}
+
+    def rules(self) -> Dict[str, Any]:
+        """影响分组结果的设置，变化时需要重新过滤"""
+        return {'enabled': self.enabled, 'suffixes': self.suffixes, 'drop_latin': self.drop_latin}
+
+    @staticmethod
+    def _fold(name: str) -> str:
+        name = unicodedata.normalize('NFKC', name).casefold()
+        # 去掉符号（含 emoji）、标点、空白、控制字符和变体选择符
+        return ''.join(ch for ch in name if unicodedata.category(ch)[0] not in 'SPZC'
+                       and not '\ufe00' <= ch <= '\ufe0f')
+
+    def _drop_suffixes(self, name: str) -> str:
+        changed = True
+        while changed:
+            changed = False
+            for suffix in self.suffixes:
+                if name.endswith(suffix) and len(name) > len(suffix):
+                    name = name[:-len(suffix)]
+                    changed = True
+                    break
+        return name
+
+    @staticmethod
+    def _drop_latin(name: str) -> str:
+        if not any('\u4e00' <= ch <= '\u9fff' for ch in name):
+            return name
+        return ''.join(ch for ch in name if not 'a' <= ch <= 'z') or name
+
+    def key(self, name: str) -> str:
+        if not self.enabled:
+            return name
+        key = self._keys.get(name)
+        if key is None:
+            key = self._fold(name) or name
+            key = self._drop_suffixes(key)
+            if self.drop_latin:
+                key = self._drop_latin(key)
+            self._keys[name] = key
+        return key
+
+
+class SiteRecord:
+    """站点的紧凑记录
+
+    site 为站点字典本身（不复制），构建时一次性计算去前缀后的名称、豆瓣标记和小写主机名；
+    ttl 为过滤阶段排序用的延迟。
+    """
+
+    __slots__ = ('key', 'site', 'original_name', 'clean_name', 'is_douban', 'host', 'ttl')
+
+    def __init__(self, key: str, site: Dict[Any, Any]):
+        self.key = key
+        self.site = site
+        if 'name' in site:
+            self.original_name = site['name']
+            # 去前缀：找到第一个'-'，去掉前面的部分
+            self.clean_name = self.original_name.split('-', 1)[1] if '-' in self.original_name else self.original_name
+        else:
+            # 没有name字段的站点
+            self.original_name = self.clean_name = 'Unknown'
+        self.is_douban = is_douban_resource(site)
+        self.host = url_host(site['api']) if site.get('api') else ''
+        self.ttl = float('inf')
+
+
+class SiteIndex:
+    """站点记录及其索引：按规范化的名称分组键和主机名
+
+    合并阶段边合并边登记记录，过滤阶段直接复用并在结束时替换为最终保留的站点，
+    生成 stream.js 时按同一份记录输出。按名称的索引随记录一起维护（分组键由 normalizer 计算），
+    按主机名的索引在第一次访问时构建。
+    """
+
+    def __init__(self, records: Iterable[SiteRecord] = (), normalizer: Optional[NameNormalizer] = None):
+        self.normalizer = normalizer or NameNormalizer()
+        self.replace(records)
+
+    @classmethod
+    def from_sites(cls, sites: Dict[str, Dict[Any, Any]], into: Optional['SiteIndex'] = None) -> 'SiteIndex':
+        """从 api_site 字典构建记录，提供 into 时在原对象上重建"""
+        index = into if into is not None else cls()
+        index.replace(SiteRecord(key, site) for key, site in sites.items())
+        return index
+
+    def replace(self, records: Iterable[SiteRecord]) -> None:
+        self.records: List[SiteRecord] = []
+        self.by_name: Dict[str, List[SiteRecord]] = defaultdict(list)
+        self._by_host: Optional[Dict[str, List[SiteRecord]]] = None
+        for record in records:
+            self.add(record)
+
+    def add(self, record: SiteRecord) -> SiteRecord:
+        self.records.append(record)
+        self.by_name[self.normalizer.key(record.clean_name)].append(record)
+        self._by_host = None
+        return record
+
+    @property
+    def by_host(self) -> Dict[str, List[SiteRecord]]:
+        if self._by_host is None:
+            self._by_host = defaultdict(list)
+            for record in self.records:
+                self._by_host[record.host].append(record)
+        return self._by_host
+
+    def douban_sites(self) -> List[SiteRecord]:
+        return [record for record in self.records if record.is_douban]
+
+    def matches(self, sites: Dict[str, Dict[Any, Any]]) -> bool:
+        """记录是否恰好对应 sites 中的站点（同样的键、同一个站点字典）"""
+        return len(self.records) == len(sites) and all(sites.get(record.key) is record.site for record in self.records)
+
+    def to_sites(self) -> Dict[str, Dict[Any, Any]]:
+        return {record.key: record.site for record in self.records}
+
+
+def remove_prefixes_and_filter_sites(json_data: Dict[Any, Any], ttl_ms: Optional[int] = None, max_test: Optional[int] = None,
+                                     prober: Optional[SiteProber] = None,
+                                     records: Optional['SiteIndex'] = None) -> Dict[Any, Any]:
+    """去除前缀、去重、测试延迟并按ttl排序，同时确保保留豆瓣资源
+
+    提供合并阶段构建的 records 时直接复用其中的站点记录，处理完成后 records 更新为最终保留的站点。
+    """
     if 'api_site' not in json_data:
         return json_data
     
@@ -139,113 +1992,86 @@ def remove_prefixes_and_filter_sites(json_data: Dict[Any, Any], ttl_ms: Optional
             sites_dict[f"api_{i+1}"] = site
         json_data['api_site'] = sites_dict
     
-    # 第一步：收集所有站点并去前缀，同时标记豆瓣资源
-    sites_info = []
-    douban_sites = []  # 单独收集豆瓣资源
-    
-    for key, site in json_data['api_site'].items():
-        if 'name' in site:
-            name = site['name']
-            # 去前缀：找到第一个'-'，去掉前面的部分
-            if '-' in name:
-                clean_name = name.split('-', 1)[1]  # 只分割第一个'-'
-            else:
-                clean_name = name
-            
-            site_info = {
-                'key': key,
-                'original_name': name,
-                'clean_name': clean_name,
-                'site': site.copy(),
-                'is_douban': is_douban_resource(site)
-            }
-            
-            sites_info.append(site_info)
-            
-            # 如果是豆瓣资源，也加入特殊列表
-            if site_info['is_douban']:
-                douban_sites.append(site_info)
-        else:
-            # 没有name字段的站点直接保留
-            site_info = {
-                'key': key,
-                'original_name': 'Unknown',
-                'clean_name': 'Unknown', 
-                'site': site.copy(),
-                'is_douban': is_douban_resource(site)
-            }
-            sites_info.append(site_info)
-            
-            if site_info['is_douban']:
-                douban_sites.append(site_info)
+    # 第一步：收集所有站点的记录（去前缀后的名称和豆瓣标记在构建记录时计算）
+    if records is None or not records.matches(json_data['api_site']):
+        records = SiteIndex.from_sites(json_data['api_site'], records)
+    douban_sites = records.douban_sites()
     
-    print(f"原始站点数: {len(sites_info)} 个")
+    print(f"原始站点数: {len(records.records)} 个")
     print(f"豆瓣资源数: {len(douban_sites)} 个")
     
-    # 第二步：按清洁名称分组
-    from collections import defaultdict
-    name_groups = defaultdict(list)
-    for site_info in sites_info:
-        name_groups[site_info['clean_name']].append(site_info)
+    # 第二步：按规范化的名称分组（同一组中的名称变体视为重复）
+    name_groups = records.by_name
     
     duplicates = sum(1 for sites in name_groups.values() if len(sites) > 1)
     if duplicates > 0:
         print(f"发现 {duplicates} 组重复名称")
+    variants = len({record.clean_name for record in records.records}) - len(name_groups)
+    if variants > 0:
+        print(f"名称规范化合并了 {variants} 个名称变体")
     
-    # 第三步：对每组进行处理
-    final_sites_with_ttl = []
+    # 并发探测本轮所有需要测试的站点，后续规则直接读取结果；
+    # 设置了探测时间预算时按预期价值排序，预算用尽后未测试的站点不在 latencies 中
+    prober = prober or SiteProber()
+    latencies = prober.latencies(order_probes_by_value(name_groups, select_sites_to_test(name_groups, max_test), prober))
+    
+    # 第三步：对每组进行处理，保留的站点记录在 kept 中，record.ttl 为排序用的延迟
+    kept: List[SiteRecord] = []
     total_removed = 0
     tested_count = 0
     douban_preserved = None  # 记录保留的豆瓣资源
+    douban_preserved_ttl = float('inf')
+    
+    def keep(record: SiteRecord, ttl: float) -> None:
+        record.ttl = ttl
+        kept.append(record)
     
-    for clean_name, sites in name_groups.items():
+    for sites in name_groups.values():
+        # 组内第一个站点去前缀后的名称，用于日志；保留的站点使用各自去前缀后的名称
+        clean_name = sites[0].clean_name
         if max_test and tested_count >= max_test:
             # 达到测试上限，但要特殊处理豆瓣资源
-            for site_info in sites:
-                site_info['site']['name'] = clean_name
-                if site_info['is_douban'] and douban_preserved is None:
+            for record in sites:
+                record.site['name'] = record.clean_name
+                if record.is_douban and douban_preserved is None:
                     # 如果是豆瓣资源且还没有保留任何豆瓣资源，则保留
-                    final_sites_with_ttl.append({
-                        'key': site_info['key'],
-                        'site': site_info['site'],
-                        'ttl': 0  # 豆瓣资源设置较高优先级
-                    })
-                    douban_preserved = site_info
-                    print(f"✓ 保留豆瓣资源: {clean_name} (未测试)")
-                elif not site_info['is_douban']:
-                    # 非豆瓣资源直接保留（无TTL字段）
-                    final_sites_with_ttl.append({
-                        'key': site_info['key'],
-                        'site': site_info['site'],
-                        'ttl': float('inf')  # 未测试的站点排在最后
-                    })
+                    keep(record, 0)  # 豆瓣资源设置较高优先级
+                    douban_preserved = record
+                    print(f"✓ 保留豆瓣资源: {record.clean_name} (未测试)")
+                elif not record.is_douban:
+                    # 非豆瓣资源直接保留（无TTL字段），未测试的站点排在最后
+                    keep(record, float('inf'))
             continue
             
         if len(sites) == 1:
             # 只有一个站点
-            site_info = sites[0]
-            site_info['site']['name'] = clean_name  # 更新名称去掉前缀
+            record = sites[0]
+            site = record.site
+            site['name'] = clean_name  # 更新名称去掉前缀
             
             # 测试延迟（无论是否有TTL限制）
-            if 'api' in site_info['site']:
+            if 'api' in site:
                 tested_count += 1
                 print(f"测试: {clean_name}")
-                latency = test_site_latency(site_info['site']['api'])
+                if site['api'] not in latencies:
+                    # 探测时间预算用尽，与达到测试上限时一样保留并排在最后（豆瓣资源优先）
+                    print(f"  超出探测时间预算，未测试")
+                    if record.is_douban and douban_preserved is None:
+                        douban_preserved = record
+                    keep(record, 0 if record.is_douban else float('inf'))
+                    continue
+                latency = latencies[site['api']]
                 
                 if latency is not None:
                     # 添加TTL字段
-                    site_info['site']['ttl'] = int(latency)
+                    site['ttl'] = int(latency)
                     print(f"  延迟: {latency:.0f}ms")
                     
                     # 如果是豆瓣资源，优先保留
-                    if site_info['is_douban']:
-                        final_sites_with_ttl.append({
-                            'key': site_info['key'],
-                            'site': site_info['site'],
-                            'ttl': latency
-                        })
-                        if douban_preserved is None or latency < douban_preserved.get('ttl', float('inf')):
-                            douban_preserved = {**site_info, 'ttl': latency}
+                    if record.is_douban:
+                        keep(record, latency)
+                        if douban_preserved is None or latency < douban_preserved_ttl:
+                            douban_preserved, douban_preserved_ttl = record, latency
                         print(f"  ✓ 豆瓣资源保留: {clean_name}")
                     else:
                         # 非豆瓣资源按TTL限制处理
@@ -254,55 +2080,31 @@ def remove_prefixes_and_filter_sites(json_data: Dict[Any, Any], ttl_ms: Optional
                             total_removed += 1
                             continue
                         
-                        final_sites_with_ttl.append({
-                            'key': site_info['key'],
-                            'site': site_info['site'],
-                            'ttl': latency
-                        })
+                        keep(record, latency)
                 else:
                     print(f"  测试失败")
-                    if site_info['is_douban']:
+                    if record.is_douban:
                         # 豆瓣资源即使测试失败也保留
-                        site_info['site']['ttl'] = 5000  # 设置一个中等的TTL值
-                        final_sites_with_ttl.append({
-                            'key': site_info['key'],
-                            'site': site_info['site'],
-                            'ttl': 5000
-                        })
+                        site['ttl'] = 5000  # 设置一个中等的TTL值
+                        keep(record, 5000)
                         if douban_preserved is None:
-                            douban_preserved = {**site_info, 'ttl': 5000}
+                            douban_preserved, douban_preserved_ttl = record, 5000
                         print(f"  ✓ 豆瓣资源保留(测试失败): {clean_name}")
                     elif ttl_ms:  # 如果设置了TTL限制，测试失败则过滤
                         total_removed += 1
                         continue
                     else:  # 否则保留，但设置一个很高的TTL值
-                        site_info['site']['ttl'] = 9999
-                        final_sites_with_ttl.append({
-                            'key': site_info['key'],
-                            'site': site_info['site'],
-                            'ttl': 9999
-                        })
+                        site['ttl'] = 9999
+                        keep(record, 9999)
             else:
                 # 没有API字段的站点
-                if site_info['is_douban']:
+                site['ttl'] = 0
+                keep(record, 0)
+                if record.is_douban:
                     # 豆瓣资源保留
-                    site_info['site']['ttl'] = 0
-                    final_sites_with_ttl.append({
-                        'key': site_info['key'],
-                        'site': site_info['site'],
-                        'ttl': 0
-                    })
                     if douban_preserved is None:
-                        douban_preserved = {**site_info, 'ttl': 0}
+                        douban_preserved, douban_preserved_ttl = record, 0
                     print(f"  ✓ 豆瓣资源保留(无API): {clean_name}")
-                else:
-                    # 非豆瓣资源直接保留，TTL设为0
-                    site_info['site']['ttl'] = 0
-                    final_sites_with_ttl.append({
-                        'key': site_info['key'],
-                        'site': site_info['site'],
-                        'ttl': 0
-                    })
         else:
             # 多个重名站点，需要去重
             print(f"\n处理重复组: \"{clean_name}\" ({len(sites)} 个站点)")
@@ -311,41 +2113,51 @@ def remove_prefixes_and_filter_sites(json_data: Dict[Any, Any], ttl_ms: Optional
             best_latency = float('inf')
             best_douban_site = None
             best_douban_latency = float('inf')
+            untested_site = None
+            untested_douban_site = None
             
             # 分别处理豆瓣和非豆瓣资源
-            douban_sites_in_group = [s for s in sites if s['is_douban']]
-            non_douban_sites_in_group = [s for s in sites if not s['is_douban']]
+            douban_sites_in_group = [s for s in sites if s.is_douban]
+            non_douban_sites_in_group = [s for s in sites if not s.is_douban]
             
             # 测试豆瓣资源
-            for site_info in douban_sites_in_group:
+            for record in douban_sites_in_group:
                 if max_test and tested_count >= max_test:
                     break
-                if 'api' in site_info['site']:
+                if 'api' in record.site:
                     tested_count += 1
-                    latency = test_site_latency(site_info['site']['api'])
+                    if record.site['api'] not in latencies:
+                        print(f"  {record.original_name} (豆瓣): 超出探测时间预算，未测试")
+                        untested_douban_site = untested_douban_site or record
+                        continue
+                    latency = latencies[record.site['api']]
                     
                     if latency is not None:
-                        print(f"  {site_info['original_name']} (豆瓣): {latency:.0f}ms")
+                        print(f"  {record.original_name} (豆瓣): {latency:.0f}ms")
                         if latency < best_douban_latency:
                             best_douban_latency = latency
-                            best_douban_site = site_info
+                            best_douban_site = record
                     else:
-                        print(f"  {site_info['original_name']} (豆瓣): FAILED")
+                        print(f"  {record.original_name} (豆瓣): FAILED")
                         # 豆瓣资源即使失败也可能被保留
                         if best_douban_site is None:
-                            best_douban_site = site_info
+                            best_douban_site = record
                             best_douban_latency = 5000
             
             # 测试非豆瓣资源
-            for site_info in non_douban_sites_in_group:
+            for record in non_douban_sites_in_group:
                 if max_test and tested_count >= max_test:
                     break
-                if 'api' in site_info['site']:
+                if 'api' in record.site:
                     tested_count += 1
-                    latency = test_site_latency(site_info['site']['api'])
+                    if record.site['api'] not in latencies:
+                        print(f"  {record.original_name}: 超出探测时间预算，未测试")
+                        untested_site = untested_site or record
+                        continue
+                    latency = latencies[record.site['api']]
                     
                     if latency is not None:
-                        print(f"  {site_info['original_name']}: {latency:.0f}ms")
+                        print(f"  {record.original_name}: {latency:.0f}ms")
                         
                         # 如果有TTL限制，只考虑符合条件的站点
                         if ttl_ms and latency > ttl_ms:
@@ -354,32 +2166,36 @@ def remove_prefixes_and_filter_sites(json_data: Dict[Any, Any], ttl_ms: Optional
                             
                         if latency < best_latency:
                             best_latency = latency
-                            best_site = site_info
+                            best_site = record
                     else:
-                        print(f"  {site_info['original_name']}: FAILED")
+                        print(f"  {record.original_name}: FAILED")
             
             # 优先保留豆瓣资源
             if best_douban_site:
-                best_douban_site['site']['name'] = clean_name
-                best_douban_site['site']['ttl'] = int(best_douban_latency)
-                final_sites_with_ttl.append({
-                    'key': best_douban_site['key'],
-                    'site': best_douban_site['site'],
-                    'ttl': best_douban_latency
-                })
-                if douban_preserved is None or best_douban_latency < douban_preserved.get('ttl', float('inf')):
-                    douban_preserved = {**best_douban_site, 'ttl': best_douban_latency}
-                print(f"  -> ✓ 保留豆瓣资源: {best_douban_site['original_name']} (延迟: {best_douban_latency:.0f}ms)")
+                best_douban_site.site['name'] = best_douban_site.clean_name
+                best_douban_site.site['ttl'] = int(best_douban_latency)
+                keep(best_douban_site, best_douban_latency)
+                if douban_preserved is None or best_douban_latency < douban_preserved_ttl:
+                    douban_preserved, douban_preserved_ttl = best_douban_site, best_douban_latency
+                print(f"  -> ✓ 保留豆瓣资源: {best_douban_site.original_name} (延迟: {best_douban_latency:.0f}ms)")
+                total_removed += len(sites) - 1
+            elif untested_douban_site:
+                untested_douban_site.site['name'] = untested_douban_site.clean_name
+                keep(untested_douban_site, 0)
+                if douban_preserved is None:
+                    douban_preserved = untested_douban_site
+                print(f"  -> ✓ 保留豆瓣资源: {untested_douban_site.original_name} (未测试)")
                 total_removed += len(sites) - 1
             elif best_site:
-                best_site['site']['name'] = clean_name
-                best_site['site']['ttl'] = int(best_latency)
-                final_sites_with_ttl.append({
-                    'key': best_site['key'],
-                    'site': best_site['site'],
-                    'ttl': best_latency
-                })
-                print(f"  -> 保留: {best_site['original_name']} (延迟: {best_latency:.0f}ms)")
+                best_site.site['name'] = best_site.clean_name
+                best_site.site['ttl'] = int(best_latency)
+                keep(best_site, best_latency)
+                print(f"  -> 保留: {best_site.original_name} (延迟: {best_latency:.0f}ms)")
+                total_removed += len(sites) - 1
+            elif untested_site:
+                untested_site.site['name'] = untested_site.clean_name
+                keep(untested_site, float('inf'))
+                print(f"  -> 保留: {untested_site.original_name} (未测试)")
                 total_removed += len(sites) - 1
             else:
                 print(f"  -> 所有站点都不符合要求，全部过滤")
@@ -392,82 +2208,109 @@ def remove_prefixes_and_filter_sites(json_data: Dict[Any, Any], ttl_ms: Optional
         best_douban = None
         best_douban_ttl = float('inf')
         
-        for douban_site in douban_sites:
-            if 'api' in douban_site['site']:
-                latency = test_site_latency(douban_site['site']['api'])
+        # 只补测之前没有测试过的豆瓣资源
+        untested = [s.site['api'] for s in douban_sites if 'api' in s.site and s.site['api'] not in latencies]
+        latencies.update(prober.latencies(untested))
+        
+        for record in douban_sites:
+            if 'api' in record.site:
+                latency = latencies.get(record.site['api'])
                 if latency is not None and latency < best_douban_ttl:
                     best_douban_ttl = latency
-                    best_douban = douban_site
+                    best_douban = record
                 elif latency is None and best_douban is None:
                     # 如果没有找到可测试的，至少保留一个
-                    best_douban = douban_site
+                    best_douban = record
                     best_douban_ttl = 9999
             elif best_douban is None:
                 # 没有API的豆瓣资源
-                best_douban = douban_site
+                best_douban = record
                 best_douban_ttl = 0
         
         if best_douban:
-            best_douban['site']['ttl'] = int(best_douban_ttl)
-            final_sites_with_ttl.append({
-                'key': best_douban['key'],
-                'site': best_douban['site'],
-                'ttl': best_douban_ttl
-            })
-            print(f"✓ 强制保留豆瓣资源: {best_douban['clean_name']} (TTL: {best_douban_ttl:.0f}ms)")
+            best_douban.site['ttl'] = int(best_douban_ttl)
+            keep(best_douban, best_douban_ttl)
+            print(f"✓ 强制保留豆瓣资源: {best_douban.clean_name} (TTL: {best_douban_ttl:.0f}ms)")
     
     # 第四步：按TTL排序
     print(f"\n按TTL排序...")
-    final_sites_with_ttl.sort(key=lambda x: x['ttl'])
+    kept.sort(key=lambda record: record.ttl)
     
-    # 重新生成键名并构建最终结果
-    final_sites = {}
-    for i, site_data in enumerate(final_sites_with_ttl, 1):
-        new_key = f"api_{i}"
-        final_sites[new_key] = site_data['site']
+    # 重新生成键名并构建最终结果，records 同步为最终保留的站点
+    input_count = len(records.records)
+    for i, record in enumerate(kept, 1):
+        record.key = f"api_{i}"
+    records.replace(kept)
+    final_sites = records.to_sites()
     
     json_data['api_site'] = final_sites
     
+    metrics.incr('sites_input', input_count)
+    metrics.incr('sites_dropped', total_removed)
+    metrics.incr('sites_kept', len(final_sites))
+    
     print(f"\n处理完成:")
-    print(f"- 原始站点: {len(sites_info)} 个")
+    print(f"- 原始站点: {input_count} 个")
     print(f"- 去重/过滤: {total_removed} 个") 
     print(f"- 最终保留: {len(final_sites)} 个站点")
     print(f"- 已按TTL从小到大排序")
-    if douban_preserved or any('豆瓣' in site.get('name', '').lower() or 'douban' in site.get('name', '').lower() or 'douban' in site.get('api', '').lower() for site in final_sites.values()):
+    if douban_preserved or any(record.is_douban for record in kept):
         print(f"✓ 已确保保留豆瓣资源")
     
     return json_data
 
 
-def merge_subscriptions(subscription_list: List[Dict[Any, Any]]) -> Dict[Any, Any]:
-    """合并订阅源并去重"""
-    if not subscription_list:
+def merge_subscriptions(subscriptions: Iterable[Dict[Any, Any]],
+                        index: Optional[EndpointIndex] = None,
+                        records: Optional[SiteIndex] = None) -> Dict[Any, Any]:
+    """合并订阅源并按端点去重（忽略 http/https、默认端口和末尾斜杠的差异）
+
+    subscriptions 可以是生成器：逐个消费并合并，合并后不再持有该订阅源，
+    只有被保留的站点留在结果中。
+    提供 records 时同时为合并结果中的每个站点登记记录，供过滤阶段直接复用。
+    """
+    subscriptions = iter(subscriptions)
+    first = next(subscriptions, None)
+    if first is None:
         return {}
     
+    index = index if index is not None else EndpointIndex()
+    
     # 使用第一个订阅源作为基础
-    base_json = subscription_list[0].copy()
+    base_json = first.copy()
+    first = None
     
     if 'api_site' not in base_json:
         base_json['api_site'] = {}
     
     # 统一转换为字典格式
     if isinstance(base_json['api_site'], list):
-        # 如果是列表，转换为字典
-        sites_dict = {}
-        for i, site in enumerate(base_json['api_site']):
-            sites_dict[f"api_{i+1}"] = site
-        base_json['api_site'] = sites_dict
+        base_sites = base_json['api_site']
+    else:
+        base_sites = list(base_json['api_site'].values())
     
-    # 创建 set 用于去重
-    existing_apis = set()
-    for site in base_json['api_site'].values():
+    # 基础订阅源内部也按端点去重，保留第一次出现的站点并重新编号
+    sites_dict = {}
+    collapsed = 0
+    for site in base_sites:
         if 'api' in site:
-            existing_apis.add(site['api'])
+            if index.has_endpoint(site['api']):
+                collapsed += 1
+                continue
+            index.add(site['api'])
+        new_key = f"api_{len(sites_dict) + 1}"
+        sites_dict[new_key] = site
+        if records is not None:
+            records.add(SiteRecord(new_key, site))
+    base_json['api_site'] = sites_dict
+    base_sites = None
     
     print(f"Base subscription has {len(base_json['api_site'])} sites")
+    if collapsed:
+        print(f"Collapsed {collapsed} duplicate endpoints in base subscription")
     
     # 合并其他订阅源
-    for i, subscription in enumerate(subscription_list[1:], 1):
+    for i, subscription in enumerate(subscriptions, 1):
         if 'api_site' not in subscription:
             continue
             
@@ -481,14 +2324,17 @@ def merge_subscriptions(subscription_list: List[Dict[Any, Any]]) -> Dict[Any, An
             sites_iter = sites_to_merge
         
         for site in sites_iter:
-            if 'api' in site and site['api'] not in existing_apis:
+            if 'api' in site and not index.has_endpoint(site['api']):
                 # 生成新的键名
                 new_key = f"api_{len(base_json['api_site']) + 1}"
                 base_json['api_site'][new_key] = site
-                existing_apis.add(site['api'])
+                index.add(site['api'])
+                if records is not None:
+                    records.add(SiteRecord(new_key, site))
                 added_count += 1
         
         print(f"Added {added_count} unique sites from subscription {i}")
+        subscription = sites_to_merge = sites_iter = None
     
     print(f"Final merged subscription has {len(base_json['api_site'])} sites")
     return base_json
@@ -503,71 +2349,284 @@ def apply_custom_settings(merged_json: Dict[Any, Any], cache_time: Optional[str]
     return merged_json
 
 
-def encode_and_save(merged_json: Dict[Any, Any], output_file: str = 'merged_config.b58') -> None:
-    """编码并保存最终配置"""
-    # 转换为格式化的 JSON 字符串（美化格式）
-    json_str = json.dumps(merged_json, ensure_ascii=False, indent=2, sort_keys=True)
+DELTA_VERSION = 2
+DELTA_FILE = 'merged_config.delta.json'
+
+
+def get_delta_file() -> Optional[str]:
+    """DELTA_OUTPUT 开启时返回增量文件名，否则返回 None"""
+    return DELTA_FILE if get_env_bool('DELTA_OUTPUT') else None
+
+
+def load_published_config(path: str) -> Optional[Dict[Any, Any]]:
+    """读取并解码已发布的 BASE58 配置，文件不存在或无法解码时返回 None"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            text = f.read().strip()
+        if not text:
+            return None
+        config = json.loads(unwrap_payload(base58_decode(text)))
+    except FileNotFoundError:
+        return None
+    except (ValueError, zlib.error) as e:
+        print(f"Warning: cannot decode previous config {path}: {e}")
+        return None
+    return config if isinstance(config, dict) else None
+
+
+def _pointer(path: str, key: Any) -> str:
+    """在 JSON Pointer 后追加一级（按 RFC 6901 转义 ~ 和 /）"""
+    return f"{path}/{str(key).replace('~', '~0').replace('/', '~1')}"
+
+
+def _same_value(a: Any, b: Any) -> bool:
+    """严格比较两个 JSON 值（1、1.0 与 true 视为不同）"""
+    if type(a) is not type(b):
+        return False
+    if isinstance(a, dict):
+        return a.keys() == b.keys() and all(_same_value(a[key], b[key]) for key in a)
+    if isinstance(a, list):
+        return len(a) == len(b) and all(_same_value(x, y) for x, y in zip(a, b))
+    return a == b
+
+
+def diff_configs(base: Any, target: Any, path: str = '') -> List[Dict[str, Any]]:
+    """生成把 base 变为 target 的 JSON Patch 风格操作（add / remove / replace）
+
+    字典逐键递归比较；等长列表逐项递归比较，长度不同的列表整体替换。
+    """
+    if isinstance(base, dict) and isinstance(target, dict):
+        ops = [{'op': 'remove', 'path': _pointer(path, key)} for key in base if key not in target]
+        for key, value in target.items():
+            if key not in base:
+                ops.append({'op': 'add', 'path': _pointer(path, key), 'value': value})
+            else:
+                ops.extend(diff_configs(base[key], value, _pointer(path, key)))
+        return ops
+    if isinstance(base, list) and isinstance(target, list) and len(base) == len(target):
+        ops = []
+        for i, (old, new) in enumerate(zip(base, target)):
+            ops.extend(diff_configs(old, new, _pointer(path, i)))
+        return ops
+    if _same_value(base, target):
+        return []
+    return [{'op': 'replace', 'path': path, 'value': target}]
+
+
+def _site_identities(sites: Dict[str, Any]) -> List[str]:
+    """api_site 中每个站点的身份：API URL 的端点键（没有 api 时用站点键），重复时追加序号"""
+    identities: List[str] = []
+    seen: Dict[str, int] = {}
+    for key, site in sites.items():
+        api = site.get('api') if isinstance(site, dict) else None
+        try:
+            identity = endpoint_key(api) if isinstance(api, str) and api else f"key:{key}"
+        except ValueError:
+            identity = api
+        seen[identity] = seen.get(identity, 0) + 1
+        identities.append(identity if seen[identity] == 1 else f"{identity}#{seen[identity]}")
+    return identities
+
+
+def _diff_sequence(base: List[Any], target: List[Any]) -> List[list]:
+    """生成把 base 列表变为 target 的区间替换操作 [起点, 终点, 替换内容]，按从前到后的顺序"""
+    matcher = difflib.SequenceMatcher(None, base, target, autojunk=False)
+    return [[i1, i2, target[j1:j2]] for tag, i1, i2, j1, j2 in matcher.get_opcodes() if tag != 'equal']
+
+
+def _apply_sequence(base: List[Any], ops: List[list]) -> List[Any]:
+    result = list(base)
+    # 从后往前替换，前面的下标不受影响
+    for start, end, items in reversed(ops):
+        result[start:end] = items
+    return result
+
+
+def _split_sites(config: Dict[Any, Any]) -> tuple:
+    """拆出 api_site：返回 (其余配置, 站点键列表, 身份列表, 身份 -> 站点)，其余配置中的 api_site 以空对象占位"""
+    rest = {key: ({} if key == 'api_site' else value) for key, value in config.items()}
+    sites = config.get('api_site', {})
+    identities = _site_identities(sites)
+    return rest, list(sites), identities, dict(zip(identities, sites.values()))
+
+
+def make_delta(base: Dict[Any, Any], target: Dict[Any, Any]) -> Dict[str, Any]:
+    """生成 base -> target 的增量，base_hash / target_hash 为两份配置的 content_hash
+
+    api_site 的键按排名编号（api_1、api_2……），插入或调整一个站点的排名会改变之后所有站点的键，
+    因此两边的 api_site 都是字典时按站点身份（端点键）比较：sites.ops 为按身份的站点内容变化，
+    sites.order 和 sites.keys 为身份序列和键序列的区间替换；其余配置照常比较。
+    """
+    delta: Dict[str, Any] = {
+        'version': DELTA_VERSION,
+        'base_hash': content_hash(base),
+        'target_hash': content_hash(target),
+    }
+    if isinstance(base.get('api_site', {}), dict) and isinstance(target.get('api_site', {}), dict):
+        base_rest, base_keys, base_ids, base_sites = _split_sites(base)
+        target_rest, target_keys, target_ids, target_sites = _split_sites(target)
+        delta['ops'] = diff_configs(base_rest, target_rest)
+        delta['sites'] = {
+            'ops': diff_configs(base_sites, target_sites),
+            'order': _diff_sequence(base_ids, target_ids),
+            'keys': _diff_sequence(base_keys, target_keys),
+        }
+    else:
+        delta['ops'] = diff_configs(base, target)
+    return delta
+
+
+def delta_op_count(delta: Dict[str, Any]) -> int:
+    """增量中的操作数（含站点内容和顺序的变化）"""
+    sites = delta.get('sites', {})
+    return len(delta['ops']) + sum(len(sites.get(name, [])) for name in ('ops', 'order', 'keys'))
+
+
+def _apply_ops(result: Any, ops: List[Dict[str, Any]]) -> Any:
+    """按顺序就地应用 add / remove / replace 操作并返回结果（替换根节点时返回新对象）"""
+    for op in ops:
+        keys = [part.replace('~1', '/').replace('~0', '~') for part in op['path'].split('/')[1:]]
+        if not keys:
+            if op['op'] != 'replace':
+                raise ValueError(f"Invalid delta operation on document root: {op['op']}")
+            result = op['value']
+            continue
+        parent = result
+        try:
+            for key in keys[:-1]:
+                parent = parent[int(key)] if isinstance(parent, list) else parent[key]
+            last = int(keys[-1]) if isinstance(parent, list) else keys[-1]
+            if op['op'] in ('add', 'replace'):
+                parent[last] = op['value']
+            elif op['op'] == 'remove':
+                del parent[last]
+            else:
+                raise ValueError(f"Unknown delta operation: {op['op']}")
+        except (KeyError, IndexError, TypeError) as e:
+            raise ValueError(f"Cannot apply delta operation at {op['path']}: {e}") from e
+    return result
+
+
+def apply_delta(config: Dict[Any, Any], delta: Dict[str, Any]) -> Dict[Any, Any]:
+    """把增量应用到旧配置上并返回新配置（不修改传入的 config）
+
+    增量版本不受支持、base_hash 与 config 不符或结果与 target_hash 不符时抛出 ValueError。
+    """
+    if delta.get('version') != DELTA_VERSION:
+        raise ValueError(f"Unsupported delta version: {delta.get('version')!r}")
+    if content_hash(config) != delta.get('base_hash'):
+        raise ValueError("Delta base_hash does not match the given config")
+    # 通过 JSON 往返得到深拷贝
+    result = json.loads(json.dumps(config, ensure_ascii=False))
+    if 'sites' in delta:
+        if not isinstance(result.get('api_site', {}), dict):
+            raise ValueError("Delta expects api_site to be an object")
+        result, keys, identities, sites = _split_sites(result)
+        sites = _apply_ops(sites, delta['sites'].get('ops', []))
+        keys = _apply_sequence(keys, delta['sites'].get('keys', []))
+        identities = _apply_sequence(identities, delta['sites'].get('order', []))
+        if len(keys) != len(identities) or not all(identity in sites for identity in identities):
+            raise ValueError("Delta site order does not match the site entries")
+        result = _apply_ops(result, delta['ops'])
+        if isinstance(result, dict) and 'api_site' in result:
+            result['api_site'] = {key: sites[identity] for key, identity in zip(keys, identities)}
+    else:
+        result = _apply_ops(result, delta['ops'])
+    if content_hash(result) != delta.get('target_hash'):
+        raise ValueError("Delta result does not match target_hash")
+    return result
+
+
+def save_delta(previous: Optional[Dict[Any, Any]], target: Dict[Any, Any], delta_file: str,
+               full_size: Optional[int] = None) -> None:
+    """写出相对上一次发布配置的增量
+
+    没有可用的上一次配置，或增量不小于完整配置（full_size，编码前的字节数）时不输出增量，
+    并删除旧增量，避免指向过期的版本。
+    """
+    if previous is None:
+        if os.path.exists(delta_file):
+            os.remove(delta_file)
+        print("No previous config to diff against, delta skipped")
+        return
+    delta = make_delta(previous, target)
+    content = json.dumps(delta, ensure_ascii=False, separators=(',', ':'), sort_keys=True)
+    size = len(content.encode('utf-8'))
+    if full_size is not None and size >= full_size:
+        if os.path.exists(delta_file):
+            os.remove(delta_file)
+        print(f"Delta ({size} bytes) is not smaller than the full config ({full_size} bytes), delta skipped")
+        return
+    write_if_changed(delta_file, content)
+    metrics.incr('delta_bytes', size)
+    metrics.incr('delta_ops', delta_op_count(delta))
+    print(f"Delta saved to: {delta_file} ({delta_op_count(delta)} ops, {len(content)} characters)")
+
+
+def encode_and_save(merged_json: Dict[Any, Any], output_file: str = 'merged_config.b58',
+                    output_format: str = 'pretty', delta_file: Optional[str] = None) -> None:
+    """编码并保存最终配置；提供 delta_file 时同时输出相对上一次发布配置的增量"""
+    # 按输出格式序列化（pretty 为原有的美化格式）
+    start_time = time.time()
+    payload = serialize_config(merged_json, output_format)
     
-    print(f"JSON size before encoding: {len(json_str)} characters")
+    print(f"Output format: {output_format}")
+    print(f"Payload size before encoding: {len(payload)} bytes")
     
     # BASE58 编码
-    encoded_content = base58.b58encode(json_str.encode('utf-8')).decode('utf-8')
+    encoded_content = base58_encode(payload).decode('utf-8')
+    print(f"Encoded in {time.time() - start_time:.2f}s")
+    metrics.incr('output_bytes', len(encoded_content))
     
-    # 保存到文件
-    with open(output_file, 'w', encoding='utf-8') as f:
-        f.write(encoded_content)
+    # 上一次发布的配置需要在覆盖之前读取
+    previous = load_published_config(output_file) if delta_file else None
     
-    print(f"Merged configuration saved to: {output_file}")
+    # 保存到文件（内容相同则不改写，避免无意义的提交）
+    if write_if_changed(output_file, encoded_content):
+        print(f"Merged configuration saved to: {output_file}")
+        if delta_file:
+            # 按发布内容重新解析，保证增量与客户端解码得到的配置一致
+            save_delta(previous, json.loads(unwrap_payload(payload)), delta_file, full_size=len(payload))
+    else:
+        print(f"Merged configuration unchanged: {output_file}")
     print(f"Encoded size: {len(encoded_content)} characters")
-    print(f"Expansion ratio: {len(encoded_content)/len(json_str):.2f}x")
+    print(f"Expansion ratio: {len(encoded_content)/len(payload):.2f}x")
 
 
-def generate_stream_js(sites: Dict[Any, Any], output_file: str = 'stream.js') -> None:
-    """生成 stream.js 文件中的 RESOURCE_SITES 内容，并验证 URL 合法性"""
+def generate_stream_js(sites: Dict[Any, Any], output_file: str = 'stream.js',
+                       prober: Optional[SiteProber] = None, records: Optional[SiteIndex] = None) -> None:
+    """生成 stream.js 文件中的 RESOURCE_SITES 内容，URL 合法性来自统一探测的结果"""
     print("\n生成 stream.js 格式的资源站点列表...")
     
-    valid_sites = []
+    # 过滤阶段的站点记录与 sites 一致时直接按记录输出
+    if records is not None and records.matches(sites):
+        site_list = [record.site for record in records.records]
+    else:
+        site_list = list(sites.values())
     
-    for key, site in sites.items():
-        if 'name' in site and 'api' in site:
-            name = site['name']
-            api_url = site['api']
-            
-            # 验证 URL
-            is_valid = False
-            final_url = api_url
-            
-            # 尝试原始 URL
-            try:
-                response = requests.get(api_url, params={'ac': "detail", 'wd': "庆余年"}, timeout=5)
-                if response.status_code == 200:
-                    data = response.json()
-                    if data.get('code') == 1 and data.get('list') and len(data.get('list', [])) > 0:
-                        is_valid = True
-                        print(f"✓ URL 有效: {name}")
-            except Exception as e:
-                pass
-            
-            # 如果原始 URL 无效，尝试 vod/at/json 格式
-            if not is_valid:
-                try:
-                    modified_url = api_url.rstrip('/') + '/at/json/'
-                    response = requests.get(modified_url, params={'ac': "detail", 'wd': "庆余年"}, timeout=5)
-                    if response.status_code == 200:
-                        data = response.json()
-                        if data.get('code') == 1 and data.get('list') and len(data.get('list', [])) > 0:
-                            is_valid = True
-                            final_url = modified_url
-                            print(f"✓ URL 修正后有效: {name}")
-                except Exception as e:
-                    pass
-            
-            if is_valid:
-                if final_url.endswith('/'):
-                    final_url = final_url[:-1]
-                valid_sites.append((name, final_url))
+    # 延迟测试阶段已经探测过的站点直接复用结果，其余站点在这里补充探测
+    prober = prober or SiteProber()
+    results = prober.probe(site['api'] for site in site_list if 'name' in site and 'api' in site)
+    
+    # 按站点原有顺序输出，保证结果稳定
+    valid_sites = []
+    for site in site_list:
+        if 'name' not in site or 'api' not in site:
+            continue
+        name = site['name']
+        final_url = probe_result_url(site['api'], results[site['api']])
+        if final_url is None:
+            continue
+        if final_url == site['api']:
+            print(f"✓ URL 有效: {name}")
+        else:
+            print(f"✓ URL 修正后有效: {name}")
+        if final_url.endswith('/'):
+            final_url = final_url[:-1]
+        valid_sites.append((name, final_url))
     
     print(f"验证完成: {len(valid_sites)}/{len(sites)} 个站点有效")
+    metrics.incr('stream_sites_valid', len(valid_sites))
     
     lines = ['const RESOURCE_SITES = `']
     for name, url in valid_sites:
@@ -586,52 +2645,449 @@ def generate_stream_js(sites: Dict[Any, Any], output_file: str = 'stream.js') ->
         existing_content = ''
     
     if existing_content:
-        import re
         pattern = r'const RESOURCE_SITES = `.*?`;'
         new_content = re.sub(pattern, resource_sites_content, existing_content, flags=re.DOTALL)
     else:
         new_content = resource_sites_content + '\n\n' + existing_content
     
-    with open(output_file, 'w', encoding='utf-8') as f:
-        f.write(new_content)
-    
-    print(f"stream.js updated: {output_file}")
+    if write_if_changed(output_file, new_content):
+        print(f"stream.js updated: {output_file}")
+    else:
+        print(f"stream.js unchanged: {output_file}")
 
 
-def main():
-    """主函数"""
-    print("=== 订阅源合并工具 (豆瓣资源保护版) ===")
-    
+def run_pipeline(state: Optional[SubscriptionState] = None, cache: Optional[ProbeCache] = None,
+                 breaker: Optional[CircuitBreaker] = None, history: Optional[LatencyHistory] = None) -> str:
+    """执行一次完整的合并流程，返回运行状态（ok / skipped）
+
+    常驻模式会传入跨轮复用的订阅源状态、探测缓存、熔断器和延迟历史，未提供时从磁盘加载。
+    """
     # 1. 加载配置
-    urls, cache_time, ttl, max_test_sites = load_config()
+    with metrics.span('config'):
+        urls, cache_time, ttl, max_test_sites = load_config()
+        output_format = get_output_format()
     
-    # 2. 获取和解码所有订阅源
-    subscriptions = []
-    for url in urls:
-        json_data = fetch_and_decode_subscription(url)
-        if json_data:
-            subscriptions.append(json_data)
+    # 2. 流式获取、解码并合并订阅源（按 SUBSCRIPTION_URLS 的顺序逐个合并，合并后立即释放；
+    #    未变化的订阅源跳过下载和解码；端点索引在本轮运行中复用于探测阶段）
+    with metrics.span('fetch_merge'):
+        state = state or SubscriptionState()
+        index = EndpointIndex()
+        records = SiteIndex()
+        loaded = [0]
+
+        def decoded() -> Iterator[Dict[Any, Any]]:
+            for json_data in iter_subscriptions(urls, state=state):
+                if json_data:
+                    loaded[0] += 1
+                    yield json_data
+
+        merged_json = merge_subscriptions(decoded(), index, records)
     
-    if not subscriptions:
+    if not loaded[0]:
         print("Error: No valid subscriptions found")
         sys.exit(1)
     
-    print(f"Successfully loaded {len(subscriptions)} subscriptions")
+    print(f"Successfully loaded {loaded[0]} subscriptions")
+    
+    # 合并结果和相关设置都未变化时，跳过后续的测试、编码和 stream.js 生成
+    inputs_hash = content_hash({'merged': merged_json, 'cache_time': cache_time, 'ttl': ttl,
+                                'max_test_sites': max_test_sites, 'output_format': output_format,
+                                'names': records.normalizer.rules(), 'probe': get_probe_params(),
+                                'delta': get_delta_file()})
+    if state.is_build_current(inputs_hash, ['merged_config.b58', 'stream.js']):
+        state.save()
+        print("Inputs unchanged since last build, skipping probe/encode/stream.js stages")
+        return 'skipped'
     
-    # 3. 合并与去重
-    merged_json = merge_subscriptions(subscriptions)
+    # 3. 并发预解析 api_site 中所有不同的主机名，之后的请求直接使用缓存的地址
+    with metrics.span('dns'):
+        dns_cache.prefetch(records.by_host)
     
     # 4. 去前缀、去重并过滤高延迟站点（保护豆瓣资源）
-    merged_json = remove_prefixes_and_filter_sites(merged_json, ttl, max_test_sites)
+    with metrics.span('filter'):
+        cache = cache or ProbeCache()
+        breaker = breaker or CircuitBreaker()
+        history = history or LatencyHistory()
+        prober = SiteProber(cache=cache, index=index, breaker=breaker, history=history)
+        merged_json = remove_prefixes_and_filter_sites(merged_json, ttl, max_test_sites, prober, records)
     
     # 5. 应用自定义设置
-    merged_json = apply_custom_settings(merged_json, cache_time)
+    with metrics.span('settings'):
+        merged_json = apply_custom_settings(merged_json, cache_time)
     
     # 6. 编码与输出
-    encode_and_save(merged_json)
+    with metrics.span('encode'):
+        encode_and_save(merged_json, output_format=output_format, delta_file=get_delta_file())
     
     # 7. 生成 stream.js 格式的资源站点列表
-    generate_stream_js(merged_json.get('api_site', {}))
+    with metrics.span('stream_js'):
+        generate_stream_js(merged_json.get('api_site', {}), prober=prober, records=records)
+    cache.save()
+    breaker.save()
+    history.save()
+    state.record_build(inputs_hash, [get_delta_file()] if get_delta_file() else [])
+    state.save()
+    return 'ok'
+
+
+class Checkpoints:
+    """分阶段运行的检查点
+
+    每个阶段把产物写入 .cache/checkpoints/<stage>.json，同时记录本阶段的参数、产物哈希、
+    所依赖阶段的产物哈希以及写出的输出文件哈希。参数、上游产物和输出文件都未变化时，
+    该阶段视为最新，可以直接跳过。
+    """
+
+    DEPENDENCIES = {
+        'fetch': (),
+        'merge': ('fetch',),
+        'filter': ('merge',),
+        'encode': ('filter',),
+        'stream-js': ('filter',),
+    }
+
+    def __init__(self, directory: Optional[str] = None):
+        self.directory = directory or os.path.join(get_cache_dir(), 'checkpoints')
+        self._checkpoints: Dict[str, Optional[Dict[str, Any]]] = {}
+
+    def read(self, stage: str) -> Optional[Dict[str, Any]]:
+        if stage not in self._checkpoints:
+            try:
+                with open(os.path.join(self.directory, stage + '.json'), 'r', encoding='utf-8') as f:
+                    self._checkpoints[stage] = json.load(f)
+            except FileNotFoundError:
+                self._checkpoints[stage] = None
+            except (OSError, ValueError) as e:
+                print(f"Warning: ignoring unreadable checkpoint {stage}: {e}")
+                self._checkpoints[stage] = None
+        return self._checkpoints[stage]
+
+    def load(self, stage: str) -> Any:
+        return self.read(stage)['data']
+
+    def is_current(self, stage: str, params: Dict[str, Any]) -> bool:
+        checkpoint = self.read(stage)
+        if checkpoint is None or checkpoint.get('params') != params:
+            return False
+        for dependency in self.DEPENDENCIES[stage]:
+            upstream = self.read(dependency)
+            if upstream is None or checkpoint['inputs'].get(dependency) != upstream['hash']:
+                return False
+        for path, expected_hash in checkpoint.get('outputs', {}).items():
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    if content_hash(f.read()) != expected_hash:
+                        return False
+            except OSError:
+                return False
+        return True
+
+    def save(self, stage: str, params: Dict[str, Any], data: Any, outputs: Iterable[str] = ()) -> None:
+        """原子写入检查点，outputs 为本阶段写出的文件，记录其哈希用于判断是否被改动"""
+        output_hashes = {}
+        for path in outputs:
+            with open(path, 'r', encoding='utf-8') as f:
+                output_hashes[path] = content_hash(f.read())
+        checkpoint = {
+            'params': params,
+            'hash': content_hash(data),
+            'inputs': {dependency: self.read(dependency)['hash'] for dependency in self.DEPENDENCIES[stage]},
+            'outputs': output_hashes,
+            'ts': time.time(),
+            'data': data,
+        }
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, stage + '.json')
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(checkpoint, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        self._checkpoints[stage] = checkpoint
+
+
+def stage_params(stage: str, config: Dict[str, Any]) -> Dict[str, Any]:
+    """各阶段影响产物的设置，变化时该阶段需要重新执行"""
+    return {
+        'fetch': {'urls': config['urls']},
+        'merge': {},
+        'filter': {'ttl': config['ttl'], 'max_test_sites': config['max_test_sites'],
+                   'names': NameNormalizer().rules(), 'probe': get_probe_params()},
+        'encode': {'cache_time': config['cache_time'], 'output_format': config['output_format'],
+                   'delta': get_delta_file()},
+        'stream-js': {},
+    }[stage]
+
+
+def stage_fetch(checkpoints: Checkpoints, config: Dict[str, Any]) -> None:
+    state = SubscriptionState()
+    subscriptions = [json_data for json_data in fetch_subscriptions(config['urls'], state=state) if json_data]
+    state.save()
+    if not subscriptions:
+        print("Error: No valid subscriptions found")
+        sys.exit(1)
+    print(f"Successfully loaded {len(subscriptions)} subscriptions")
+    checkpoints.save('fetch', stage_params('fetch', config), subscriptions)
+
+
+def stage_merge(checkpoints: Checkpoints, config: Dict[str, Any]) -> None:
+    merged_json = merge_subscriptions(checkpoints.load('fetch'))
+    checkpoints.save('merge', stage_params('merge', config), merged_json)
+
+
+def stage_filter(checkpoints: Checkpoints, config: Dict[str, Any]) -> None:
+    """过滤并保存探测结果，stream-js 阶段直接复用，不再重新探测"""
+    cache = ProbeCache()
+    breaker = CircuitBreaker()
+    history = LatencyHistory()
+    prober = SiteProber(cache=cache, breaker=breaker, history=history)
+    merged_json = remove_prefixes_and_filter_sites(checkpoints.load('merge'), config['ttl'],
+                                                   config['max_test_sites'], prober)
+    cache.save()
+    breaker.save()
+    history.save()
+    checkpoints.save('filter', stage_params('filter', config), {'config': merged_json, 'probes': prober.results})
+
+
+def stage_encode(checkpoints: Checkpoints, config: Dict[str, Any]) -> None:
+    merged_json = apply_custom_settings(checkpoints.load('filter')['config'], config['cache_time'])
+    delta_file = get_delta_file()
+    encode_and_save(merged_json, 'merged_config.b58', config['output_format'], delta_file)
+    # 没有可对比的上一版时不输出增量，只登记实际写出的文件
+    outputs = ['merged_config.b58'] + ([delta_file] if delta_file and os.path.exists(delta_file) else [])
+    checkpoints.save('encode', stage_params('encode', config), None, outputs=outputs)
+
+
+def stage_stream_js(checkpoints: Checkpoints, config: Dict[str, Any]) -> None:
+    filtered = checkpoints.load('filter')
+    cache = ProbeCache()
+    breaker = CircuitBreaker()
+    history = LatencyHistory()
+    prober = SiteProber(cache=cache, breaker=breaker, history=history)
+    prober.results.update(filtered['probes'])
+    generate_stream_js(filtered['config'].get('api_site', {}), 'stream.js', prober)
+    cache.save()
+    breaker.save()
+    history.save()
+    checkpoints.save('stream-js', stage_params('stream-js', config), None, outputs=['stream.js'])
+
+
+STAGES: Dict[str, Callable[[Checkpoints, Dict[str, Any]], None]] = {
+    'fetch': stage_fetch,
+    'merge': stage_merge,
+    'filter': stage_filter,
+    'encode': stage_encode,
+    'stream-js': stage_stream_js,
+}
+
+
+def run_stages(target: str, force: bool = False) -> str:
+    """执行 target 阶段，缺失或过期的上游检查点先重新生成；最新的阶段直接跳过，force 时强制执行 target
+
+    fetch 的输入在网络上，作为目标时总是重新获取（订阅源未变化时仍走条件请求），
+    作为上游时只要订阅源列表未变化就复用检查点。
+    """
+    urls, cache_time, ttl, max_test_sites = load_config()
+    config = {'urls': urls, 'cache_time': cache_time, 'ttl': ttl, 'max_test_sites': max_test_sites,
+              'output_format': get_output_format()}
+    checkpoints = Checkpoints()
+    chain: List[str] = []
+
+    def add_with_dependencies(stage: str) -> None:
+        for dependency in Checkpoints.DEPENDENCIES[stage]:
+            add_with_dependencies(dependency)
+        if stage not in chain:
+            chain.append(stage)
+
+    add_with_dependencies(target)
+    ran = []
+    for stage in chain:
+        forced = stage == target and (force or stage == 'fetch')
+        if not forced and checkpoints.is_current(stage, stage_params(stage, config)):
+            print(f"Stage {stage}: checkpoint up to date, skipped" + (" (use --force to rerun)" if stage == target else ""))
+            continue
+        print(f"\n--- Stage {stage} ---")
+        with metrics.span(stage.replace('-', '_')):
+            STAGES[stage](checkpoints, config)
+        ran.append(stage)
+    return 'ok' if ran else 'skipped'
+
+
+def run_once(pipeline: Callable[..., str] = run_pipeline, **kwargs: Any) -> str:
+    """执行一轮合并（默认完整流程，也可以是单个阶段）并导出本轮的运行指标"""
+    metrics.reset()
+    status = 'failed'
+    try:
+        status = pipeline(**kwargs)
+    finally:
+        metrics.export(status)
+    return status
+
+
+class MergeService:
+    """常驻服务模式
+
+    按 REFRESH_INTERVAL 秒定时刷新，刷新之间在内存中保留连接池、订阅源状态、探测缓存、熔断器和延迟历史；
+    通过 HTTP 提供最新的合并配置和 RESOURCE_SITES，支持 ETag / 304 和 gzip。
+    刷新失败时继续提供上一次成功生成的内容。
+    """
+
+    # 路径 -> (文件名, Content-Type)；resource_sites.txt 只包含 stream.js 中 RESOURCE_SITES 的内容
+    ROUTES = {
+        '/merged_config.b58': ('merged_config.b58', 'text/plain; charset=utf-8'),
+        '/merged_config.delta.json': (DELTA_FILE, 'application/json'),
+        '/stream.js': ('stream.js', 'application/javascript; charset=utf-8'),
+        '/resource_sites.txt': ('stream.js', 'text/plain; charset=utf-8'),
+    }
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.state = SubscriptionState()
+        self.cache = ProbeCache()
+        self.breaker = CircuitBreaker()
+        self.history = LatencyHistory()
+        self.documents: Dict[str, Dict[str, Any]] = {}
+        self.last_refresh: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def load_documents(self) -> None:
+        """读取输出文件，预先计算 ETag 和 gzip 压缩结果"""
+        documents = {}
+        for path, (filename, content_type) in self.ROUTES.items():
+            try:
+                with open(filename, 'r', encoding='utf-8') as f:
+                    text = f.read()
+            except FileNotFoundError:
+                continue
+            if path == '/resource_sites.txt':
+                match = re.search(r'const RESOURCE_SITES = `(.*?)`;', text, flags=re.DOTALL)
+                if not match:
+                    continue
+                text = match.group(1).strip() + '\n'
+            body = text.encode('utf-8')
+            documents[path] = {
+                'body': body,
+                'gzip': gzip.compress(body, mtime=0),
+                'etag': f'"{content_hash(body)[:32]}"',
+                'content_type': content_type,
+            }
+        with self._lock:
+            self.documents = documents
+
+    def refresh(self) -> None:
+        start_time = time.time()
+        try:
+            status = run_once(state=self.state, cache=self.cache, breaker=self.breaker, history=self.history)
+        # 配置缺失或没有可用订阅源时 run_pipeline 会调用 sys.exit，常驻模式下只记录失败
+        except (Exception, SystemExit) as e:
+            print(f"Refresh failed: {type(e).__name__}: {e}")
+            status = 'failed'
+        self.load_documents()
+        with self._lock:
+            self.last_refresh = {'status': status, 'finished_at': time.time(),
+                                 'duration': round(time.time() - start_time, 3)}
+
+    def run_scheduler(self) -> None:
+        while not self._stopped.is_set():
+            self.refresh()
+            print(f"Next refresh in {self.interval:g}s")
+            self._stopped.wait(self.interval)
+
+    def respond(self, path: str, headers: Any) -> tuple:
+        """返回 (状态码, 响应头, 响应体)"""
+        path = urlparse(path).path
+        if path == '/healthz':
+            with self._lock:
+                body = json.dumps({'last_refresh': self.last_refresh, 'documents': sorted(self.documents)}).encode('utf-8')
+            return 200, {'Content-Type': 'application/json'}, body
+        with self._lock:
+            document = self.documents.get(path)
+        if document is None:
+            status = 503 if path in self.ROUTES else 404
+            return status, {'Content-Type': 'text/plain; charset=utf-8'}, b'not available\n'
+        response_headers = {'ETag': document['etag'], 'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding'}
+        if_none_match = headers.get('If-None-Match', '')
+        if document['etag'] in [tag.strip() for tag in if_none_match.split(',')] or if_none_match.strip() == '*':
+            return 304, response_headers, b''
+        response_headers['Content-Type'] = document['content_type']
+        if 'gzip' in headers.get('Accept-Encoding', ''):
+            response_headers['Content-Encoding'] = 'gzip'
+            return 200, response_headers, document['gzip']
+        return 200, response_headers, document['body']
+
+    def serve(self, host: str, port: int) -> None:
+        self.load_documents()
+        threading.Thread(target=self.run_scheduler, daemon=True).start()
+        server = ThreadingHTTPServer((host, port), ServiceHandler)
+        server.service = self
+        print(f"Serving on http://{host}:{server.server_address[1]}/ (refresh every {self.interval:g}s)")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._stopped.set()
+            server.server_close()
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    """MergeService 的 HTTP 处理器"""
+
+    def _respond(self, include_body: bool) -> None:
+        status, headers, body = self.server.service.respond(self.path, self.headers)
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if status != 304:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if include_body and status != 304:
+            self.wfile.write(body)
+
+    def do_GET(self):
+        self._respond(True)
+
+    def do_HEAD(self):
+        self._respond(False)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='订阅源合并工具')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('run', help='执行一次合并（默认）')
+    for stage, description in (('fetch', '获取并解码订阅源'), ('merge', '合并与去重'), ('filter', '探测延迟并过滤站点'),
+                               ('encode', '应用自定义设置并编码输出'), ('stream-js', '生成 stream.js')):
+        stage_parser = subparsers.add_parser(stage, help=f"{description}（缺失或过期的上游阶段会先执行）")
+        stage_parser.add_argument('--force', action='store_true', help='检查点为最新时也重新执行本阶段')
+    serve = subparsers.add_parser('serve', help='常驻模式：定时刷新并通过 HTTP 提供合并结果')
+    serve.add_argument('--host', default=os.getenv('SERVE_HOST') or '127.0.0.1', help='监听地址，默认 127.0.0.1')
+    serve.add_argument('--port', type=int, default=get_env_int('SERVE_PORT', 8080), help='监听端口，默认 8080')
+    serve.add_argument('--interval', type=float, default=get_env_float('REFRESH_INTERVAL', 3600),
+                       help='刷新间隔（秒），默认 3600')
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None):
+    """主函数"""
+    load_dotenv()
+    args = parse_args(argv)
+    print("=== 订阅源合并工具 (豆瓣资源保护版) ===")
+    http_cassette.configure()
+    # 回放时不访问网络，也就不需要预解析主机名
+    if http_cassette.mode != 'replay':
+        dns_cache.install()
+    
+    if args.command == 'serve':
+        MergeService(args.interval).serve(args.host, args.port)
+        return
+    
+    if args.command in STAGES:
+        run_once(run_stages, target=args.command, force=args.force)
+    else:
+        run_once()
     
     print("=== 合并完成 ===")
 